@@ -0,0 +1,346 @@
+"""
+the asyncio ssh backend, one event loop drives all the host sessions.
+it needs the optional asyncssh package: pip3 install asyncssh
+"""
+import asyncio
+import os
+import posixpath
+import uuid
+from typing import Union
+
+try:
+    import asyncssh
+except ImportError:
+    asyncssh = None
+
+from machineroom.const import Config, TunnelType, HOST_FACTS_PROBE, DOCKER_INVENTORY_PROBE, PYTHON_CE, INSTALL_DAED, \
+    INSTALL_WATCH_TOWER
+from machineroom.containers import ContainerRecord
+from machineroom.errs import AsyncBackendMissing, MachineRoomErr
+from machineroom.fleet import HostResult, print_summary
+from machineroom.taskbase import parse_facts, apply_host_facts, program_path, parse_ports, parse_docker_inventory, LIST_PORTS
+from machineroom.tunnels import conn
+from machineroom.util import Servers, bastion_address
+
+# the stages of Config.STAGE1 this backend can run, the others need the fabric backend
+ASYNC_STAGES = ("cert", "env", "python", "daed", "watchtower")
+
+
+class AsyncResult:
+    """
+    the same fields as the fabric Result that the task functions read
+    """
+    command: str
+    stdout: str
+    stderr: str
+    exited: int
+
+    def __init__(self, command: str, stdout: str, stderr: str, exited: int):
+        self.command = command
+        self.stdout = stdout
+        self.stderr = stderr
+        self.exited = exited
+
+    @property
+    def ok(self) -> bool:
+        return self.exited == 0
+
+    @property
+    def failed(self) -> bool:
+        return not self.ok
+
+
+class AsyncConnection:
+    """
+    one asyncssh session to a host, opened on the first command
+    """
+    host: str
+    port: int
+    user: str
+    connect_kwargs: dict
+    # the bastion connection of an ssh tunnel, the session is opened through it
+    tunnel: object
+    # what the session has run, the same counters as MeteredConnection
+    commands: int
+    stdout_bytes: int
+    stderr_bytes: int
+    exit_status: int
+    # the program paths of the host found by apply_host_facts
+    programs: dict
+
+    def __init__(self, host: str, port: int, user: str, connect_kwargs: dict, tunnel=None):
+        if asyncssh is None:
+            raise AsyncBackendMissing("the asyncio backend needs asyncssh, pip3 install asyncssh")
+        self.host = host
+        self.port = int(port)
+        self.user = user
+        self.connect_kwargs = connect_kwargs
+        self.tunnel = tunnel
+        self.programs = {}
+        self.commands = 0
+        self.stdout_bytes = 0
+        self.stderr_bytes = 0
+        self.exit_status = 0
+        self._conn = None
+        self._sftp = None
+
+    async def open(self):
+        if self._conn is not None:
+            return
+        options = {
+            "port": self.port,
+            "username": self.user,
+            "known_hosts": None,
+            "connect_timeout": Config.ASYNC_CONNECT_TIMEOUT,
+        }
+        if "password" in self.connect_kwargs:
+            options["password"] = self.connect_kwargs["password"]
+        if "key_filename" in self.connect_kwargs:
+            options["client_keys"] = self.connect_kwargs["key_filename"]
+        if self.tunnel is not None:
+            options["tunnel"] = self.tunnel
+        self._conn = await asyncssh.connect(self.host, **options)
+
+    async def run(self, command: str, input: Union[str, None] = None, timeout: int = None) -> AsyncResult:
+        await self.open()
+        r = await self._conn.run(command, input=input, check=False, timeout=timeout)
+        exited = r.exit_status if r.exit_status is not None else -1
+        result = AsyncResult(command, str(r.stdout or ""), str(r.stderr or ""), exited)
+        self.commands += 1
+        self.stdout_bytes += len(result.stdout)
+        self.stderr_bytes += len(result.stderr)
+        if exited != 0:
+            self.exit_status = exited
+        return result
+
+    async def put(self, local: Union[str, bytes], remote: str):
+        """
+        upload a local file path, or the bytes themselves, to the remote file
+        """
+        await self.open()
+        if self._sftp is None:
+            self._sftp = await self._conn.start_sftp_client()
+        if isinstance(local, bytes):
+            async with self._sftp.open(remote, "wb") as f:
+                await f.write(local)
+        else:
+            await self._sftp.put(local, remote)
+
+    async def close(self):
+        if self._sftp is not None:
+            self._sftp.exit()
+            self._sftp = None
+        if self._conn is not None:
+            self._conn.close()
+            await self._conn.wait_closed()
+            self._conn = None
+
+
+async def exec_shell_program_async(c: AsyncConnection, remote_path: str, _program_: str) -> AsyncResult:
+    script_name = f"mr_{uuid.uuid4().hex}.sh"
+    await c.put(f"#!/bin/bash\n{_program_}\n".encode("utf-8"), posixpath.join(remote_path, script_name))
+    cmd0 = f'cd {remote_path} && {program_path(c, "bash")} {script_name}; mr_status=$?; rm -f {script_name}; exit $mr_status'
+    return await c.run(cmd0, timeout=3000)
+
+
+async def list_all_open_ports_async(c: AsyncConnection) -> list[int]:
+    r = await c.run(LIST_PORTS)
+    if r.ok is False:
+        raise MachineRoomErr(f"cannot list the open ports: {r.stderr.strip()}")
+    return parse_ports(r.stdout)
+
+
+async def check_docker_ps_async(c: AsyncConnection, keywords: list, is_full_match: bool = False) -> bool:
+    r = await c.run("docker ps", timeout=10)
+    if r.ok is False:
+        return False
+    line = r.stdout.strip().replace("\n", "")
+    found = [k for k in keywords if k in line]
+    if is_full_match:
+        return len(found) == len(keywords)
+    return len(found) > 0
+
+
+async def docker_inventory_async(c: AsyncConnection) -> list[ContainerRecord]:
+    r = await c.run(DOCKER_INVENTORY_PROBE.replace("COMMAND_DOCKER", program_path(c, "docker")))
+    return parse_docker_inventory(r.stdout, r.stderr)
+
+
+async def collect_facts_async(c: AsyncConnection) -> dict:
+    r = await c.run(HOST_FACTS_PROBE)
+    return parse_facts(r.stdout, r.stderr)
+
+
+async def copy_id_async(c: AsyncConnection, file: str = Config.PUB_KEY):
+    print("copy_id operation")
+    await c.put(file, "/tmp/id.pub")
+    await c.run(
+        "mkdir -p ~/.ssh; "
+        "if [ ! -f ~/.ssh/authorized_keys ]; then cp /tmp/id.pub ~/.ssh/authorized_keys && chmod 0600 ~/.ssh/authorized_keys; fi; "
+        "grep -qxF -f /tmp/id.pub ~/.ssh/authorized_keys || cat /tmp/id.pub >> ~/.ssh/authorized_keys; "
+        "rm -f /tmp/id.pub"
+    )
+
+
+class AsyncDeploymentBotFoundation:
+    """
+    the asyncio version of DeploymentBotFoundation, each host is a task on one event loop.
+    the callbacks are coroutines taking (AsyncConnection, Servers).
+    """
+    srv: Servers
+    start_server_from: int
+    concurrency: int
+
+    def __init__(self, server_room: str):
+        self.srv = Servers(server_room)
+        self.start_server_from = 0
+        self.concurrency = Config.ASYNC_CONCURRENCY
+        self._bastion = None
+        self.srv.detect_servers()
+
+    def fleet_indexes(self) -> list[int]:
+        first = self.start_server_from
+        if self.srv.has_tunnel() and first == 0:
+            first = 1
+        return [n for n in range(first, self.srv.serv_count)]
+
+    def run_tunnel_detection(self):
+        if self.srv.tunnel_type in (TunnelType.NO_TUNNEL, TunnelType.SSH):
+            # the ssh tunnel is the bastion connection opened on the event loop
+            return False
+        conn.use_macos_vpn_on(self.srv.profile_name)
+        return True
+
+    def run_tunnel_detection_off(self):
+        if self.srv.tunnel_type in (TunnelType.NO_TUNNEL, TunnelType.SSH):
+            return False
+        conn.use_macos_vpn_off(self.srv.profile_name)
+        return True
+
+    def _new_connection(self, srv: Servers) -> AsyncConnection:
+        custom_ssh_key = srv.get_cert_path()
+        use_ssh_key = custom_ssh_key and custom_ssh_key != os.path.expanduser("~/.ssh/id_rsa")
+        if srv.is_cert_installed():
+            return AsyncConnection(srv.current_host, srv.current_srv_port, srv.current_user,
+                                   {"key_filename": [custom_ssh_key]}, self._bastion)
+        connect_kwargs = {"password": srv.current_pass}
+        if use_ssh_key:
+            connect_kwargs["key_filename"] = [custom_ssh_key]
+        return AsyncConnection(srv.current_host, srv.current_srv_port, srv.current_user, connect_kwargs, self._bastion)
+
+    async def open_bastion(self):
+        """
+        the one connection to the jump host of an ssh tunnel, every host session is tunneled through it
+        """
+        bastion = self.srv.bastion
+        connect_kwargs = {}
+        if bastion["pass"] != "":
+            connect_kwargs["password"] = bastion["pass"]
+        if bastion["key"] != "":
+            connect_kwargs["key_filename"] = [bastion["key"]]
+        gateway = AsyncConnection(bastion["host"], bastion["port"], bastion["user"], connect_kwargs)
+        await gateway.open()
+        print(f"bastion {bastion_address(bastion)} connected")
+        return gateway
+
+    async def stage_1(self, c: AsyncConnection, srv: Servers):
+        for key in Config.STAGE1:
+            await self._stage_loop(c, srv, key)
+
+    async def host_facts(self, c: AsyncConnection, srv: Servers) -> dict:
+        facts = srv.local().get_facts(Config.FACTS_TTL_SECONDS)
+        if len(facts) == 0:
+            facts = await collect_facts_async(c)
+            srv.local().update_facts(facts)
+        return facts
+
+    async def has_program(self, c: AsyncConnection, srv: Servers, program: str) -> bool:
+        paths = (await self.host_facts(c, srv)).get("paths", {})
+        if program in paths:
+            return paths[program] != ""
+        r = await c.run(f"command -v {program}")
+        return r.ok
+
+    async def _stage_loop(self, c: AsyncConnection, srv: Servers, task: str):
+        if task not in ASYNC_STAGES:
+            # a skipped install would still report the host as done
+            raise MachineRoomErr(f"the asyncssh backend cannot run the stage {task}, use the fabric backend")
+
+        if task == "cert":
+            if srv.is_cert_installed() is False:
+                r = await c.run("cat ~/.ssh/authorized_keys")
+                if Config.MY_KEY_FEATURE not in r.stdout:
+                    await copy_id_async(c, Config.PUB_KEY)
+                srv.cert_install()
+
+        if task == "env":
+            apply_host_facts(c, srv.local(), await self.host_facts(c, srv))
+
+        if task == "python":
+            if srv.local().is_python_installed() is False:
+                if await self.has_program(c, srv, "python3") is False:
+                    print("python3 needs to install")
+                    await c.run(PYTHON_CE)
+                    srv.local().python3_install()
+                    srv.local().forget_facts()
+
+        if task == "daed":
+            if srv.local().is_dae_installed() is False:
+                if await self.has_program(c, srv, "daed") is False:
+                    print("daed will be installed")
+                    await c.run(INSTALL_DAED, timeout=900)
+                    srv.local().dae_install()
+                    srv.local().forget_facts()
+
+        if task == "watchtower":
+            if srv.local().is_watchtower_installed() is False:
+                if await check_docker_ps_async(c, ["containrrr/watchtower"]) is False:
+                    print("watchtower will be installed - the automatic updates of the docker container")
+                    await c.run(INSTALL_WATCH_TOWER, timeout=2900)
+                    srv.local().watchtower_install()
+
+    async def _run_host(self, index: int, callback_x, limit: asyncio.Semaphore) -> HostResult:
+        async with limit:
+            result = HostResult(index)
+            srv = self.srv.fork(share_db=True)
+            c = None
+            try:
+                srv.read_serv_at(index)
+                result.begin(srv.current_id, srv.current_host)
+                c = self._new_connection(srv)
+                with srv.local().batch():
+                    await self.stage_1(c, srv)
+                    value = await callback_x(c, srv) if callable(callback_x) else None
+                result.done(value)
+            except Exception as e:
+                print(f"======================== {result.server_id} {e}")
+                result.fail(e)
+            finally:
+                if c is not None:
+                    result.meter(c)
+                    await c.close()
+            return result
+
+    async def run_conn_async(self, callback_x=None, indexes: list[int] = None) -> list[HostResult]:
+        limit = asyncio.Semaphore(max(1, self.concurrency))
+        if indexes is None:
+            indexes = self.fleet_indexes()
+        gateway = await self.open_bastion() if self.srv.tunnel_type == TunnelType.SSH else None
+        self._bastion = gateway._conn if gateway is not None else None
+        try:
+            return list(await asyncio.gather(*[self._run_host(i, callback_x, limit) for i in indexes]))
+        finally:
+            self._bastion = None
+            if gateway is not None:
+                await gateway.close()
+
+    def run_conn(self, callback_x=None, indexes: list[int] = None) -> list[HostResult]:
+        if indexes is None:
+            indexes = self.fleet_indexes()
+        if len(indexes) == 0:
+            return []
+        self.run_tunnel_detection()
+        results = asyncio.run(self.run_conn_async(callback_x, indexes))
+        self.run_tunnel_detection_off()
+        print_summary(results)
+        return results
@@ -65,6 +65,13 @@ CMD_ADD_CERT = ["add-cert", "addingcert", "makecert", "cert-on", "on-cert", "cus
                 "sshcertifcate"]
 CMD_GENERATE_PROFILE = ["generateprofile", "gen-profile", "watch-profile", "watch_file", "watchscan"]
 CMD_SET_BASH_START = ["sethome", "startpath", "loginstart", "loginat"]
+CMD_LISTENING = ["listen", "whoport", "port-index"]
+CMD_CONTAINERS = ["container", "dps", "find-container"]
+CMD_BACKUP = ["backups", "backup-cache", "cachebackup"]
+CMD_SYNC = ["sync-folder", "syncdir", "push-folder"]
+CMD_PREWARM = ["warm", "warmup", "pre-warm"]
+CMD_CLOSE_MASTERS = ["close_masters", "closemasters", "cm-close"]
+CMD_PORT_HISTORY = ["porthistory", "portlog", "port-log"]
 DETECT_PROCESS = 'ps aux | grep -sie "{COMMAND_NAME}" | grep -v "grep -sie"'
 HEALTH_CHK_DB = """docker run --rm -it --mount type=bind,source={PWD},destination=/data sstc/sqlite3 find . -maxdepth 1 -iname "*.db" -print0 -exec sqlite3 '{}' 'PRAGMA integrity_check;' ';'"""
 HEALTH_CHK_DB2 = """
@@ -159,6 +166,7 @@ DOCKER_STOP_ID = """{COMMAND_DOCKER} stop {CID}"""
 DOCKER_STOP_RM = """{COMMAND_DOCKER} rm {CID}"""
 DOCKER_STOP_CONTAIN_NAME = """{COMMAND_DOCKER} ps -a | grep '{CONTAINER_NAME}' | awk '{{print $1}}' | xargs {COMMAND_DOCKER} stop"""
 DOCKER_RM_NAME_BASED = """{COMMAND_DOCKER} ps -a | grep '{CONTAINER_NAME}' | awk '{{print $1}}' | xargs -r {COMMAND_DOCKER} rm -f"""
+DOCKER_STOP_RM_NAME_BASED = """ids=$({COMMAND_DOCKER} ps -a | grep '{CONTAINER_NAME}' | awk '{{print $1}}'); [ -z "$ids" ] || {{ {COMMAND_DOCKER} stop $ids; {COMMAND_DOCKER} rm -f $ids; }}"""
 DOCKER_RM_VOLUME = """{COMMAND_DOCKER} volume ls -qf dangling=true -f name={CONTAINER_NAME} | xargs -r {COMMAND_DOCKER} volume rm"""
 DOCKER_LOG_REVIEW = """COMMAND_DOCKER ps -a --filter "name=__CONTAINER_KEYWORD" --format "{{.ID}}" | shuf -n 1 | xargs docker logs --tail __RECENT_LINES"""
 DOCKER_GET_NETWORK_NAME = """COMMAND_DOCKER inspect -f '{{range $key, $value := .NetworkSettings.Networks}} {{$key}} {{end}}' CONTAINER_ID"""
@@ -184,6 +192,115 @@ if [ -f "$path_to_file" ]; then
         done
     echo "compress file success"
 fi"""
+# the consistent copy of the sqlite cache, compressed and checksummed on the remote.
+# with _REUSE_=1 the last copy is kept when it is still there, so a broken download can resume on the same bytes.
+BACKUP_CACHE_SNAPSHOT = r"""
+src="_CFP_"
+out="_OUT_"
+if [ "_REUSE_" = "1" ] && [ -f "$out.meta" ]; then
+    packed=$(sed -n 's/.*"path":"\([^"]*\)".*/\1/p' "$out.meta")
+    # the meta outlives a packed copy that was removed, then a new snapshot is taken
+    if [ -n "$packed" ] && [ -f "$packed" ]; then
+        cat "$out.meta"
+        exit 0
+    fi
+fi
+[ -f "$src" ] || { echo "no cache file at $src" >&2; exit 4; }
+rm -f "$out" "$out.zst" "$out.gz" "$out.meta"
+if command -v sqlite3 >/dev/null 2>&1; then
+    sqlite3 "$src" ".timeout 10000" ".backup '$out'" || exit 5
+    method=sqlite3
+else
+    cp "$src" "$out" || exit 5
+    method=copy
+fi
+if command -v zstd >/dev/null 2>&1; then
+    zstd -q -f --rm -o "$out.zst" "$out" || exit 6
+    packed="$out.zst"
+    codec=zstd
+else
+    gzip -f "$out" || exit 6
+    packed="$out.gz"
+    codec=gzip
+fi
+sum=$(sha256sum "$packed" | awk '{print $1}')
+size=$(wc -c < "$packed" | tr -d ' ')
+printf '__MR_BACKUP__{"path":"%s","codec":"%s","method":"%s","sha256":"%s","size":%s}\n' \
+    "$packed" "$codec" "$method" "$sum" "$size" > "$out.meta"
+cat "$out.meta"
+"""
+# reads "<local sha256 or -> <remote path>" lines from stdin, prints the state of each remote file
+# and the block sums of the large changed ones, so one round trip tells what to send
+REMOTE_SYNC_PROBE = r"""
+bs=_BLOCK_SIZE_
+min=_MIN_SIZE_
+while read -r want f; do
+    [ -z "$f" ] && continue
+    mkdir -p "$(dirname "$f")"
+    if [ ! -f "$f" ]; then
+        echo "__MR_SUM__ missing 0 $f"
+        continue
+    fi
+    size=$(wc -c < "$f" | tr -d ' ')
+    if [ "$want" = "-" ]; then
+        echo "__MR_SUM__ present $size $f"
+        continue
+    fi
+    sum=$(sha256sum "$f" | awk '{print $1}')
+    if [ "$sum" = "$want" ]; then
+        echo "__MR_SUM__ same $size $f"
+        continue
+    fi
+    echo "__MR_SUM__ changed $size $f"
+    if [ "$size" -ge "$min" ]; then
+        n=$(( (size + bs - 1) / bs ))
+        i=0
+        while [ $i -lt $n ]; do
+            echo "__MR_BLOCK__ $i $(dd if="$f" bs=$bs skip=$i count=1 2>/dev/null | sha256sum | awk '{print $1}')"
+            i=$((i + 1))
+        done
+    fi
+done
+"""
+HOST_FACTS_PROBE = r"""
+json_list() {
+    first=1
+    printf '['
+    while IFS= read -r item; do
+        [ -z "$item" ] && continue
+        [ "$first" -eq 1 ] || printf ','
+        printf '"%s"' "$item"
+        first=0
+    done
+    printf ']'
+}
+mem_kb=$(awk '/^MemTotal:/ {print $2}' /proc/meminfo 2>/dev/null)
+disk_kb=$(df -Pk / 2>/dev/null | awk 'NR==2 {print $2}')
+disk_free_kb=$(df -Pk / 2>/dev/null | awk 'NR==2 {print $4}')
+ips=$(ip -o -4 addr show scope global 2>/dev/null | awk '{print $4}' | cut -d/ -f1 | json_list)
+ports=$(ss -tln 2>/dev/null | awk 'NR>1 {print $4}' | awk -F: '{print $NF}' | grep -E '^[0-9]+$' | sort -un | json_list)
+p_bash=$(command -v bash 2>/dev/null)
+p_docker=$(command -v docker 2>/dev/null)
+p_compose=$(command -v docker-compose 2>/dev/null)
+p_daed=$(command -v daed 2>/dev/null)
+p_python=$(command -v python3 2>/dev/null)
+docker_version=""
+if [ -n "$p_docker" ]; then
+    docker_version=$("$p_docker" --version 2>/dev/null | awk '/Docker version/ {print $3}' | tr -d ',')
+fi
+printf '__MR_FACTS__{"ram_kb":%s,"disk_kb":%s,"disk_free_kb":%s,"ips":%s,"ports":%s,' \
+    "${mem_kb:-0}" "${disk_kb:-0}" "${disk_free_kb:-0}" "${ips:-[]}" "${ports:-[]}"
+printf '"paths":{"bash":"%s","docker":"%s","docker-compose":"%s","daed":"%s","python3":"%s"},"docker_version":"%s"}\n' \
+    "$p_bash" "$p_docker" "$p_compose" "$p_daed" "$p_python" "$docker_version"
+"""
+# the containers of the host in one round trip, the ps lines in json and then the inspect array of all of them
+DOCKER_INVENTORY_PROBE = r"""
+echo "__MR_PS__"
+COMMAND_DOCKER ps -a --no-trunc --format '{{json .}}' || exit 3
+ids=$(COMMAND_DOCKER ps -aq --no-trunc)
+echo "__MR_INSPECT__"
+if [ -n "$ids" ]; then COMMAND_DOCKER inspect $ids; else echo "[]"; fi
+"""
 DOCKER_COMPOSE_MIHOMO = """version: '3.8'
 services:
   proxy_service:
@@ -326,3 +443,61 @@ class Config(COMMAND_PATH, PROJECT1, PROJECT2):
     SYSTEM_TEMP: str = "/tmp"
     STAGE1 = ["cert", "docker", "env"]
     DOCKER_LOG_POLICY: str = DOCKER_LOG_POLICY_10m_5f
+    # how many hosts are processed at the same time in one fleet run, 1 to run one by one
+    FLEET_CONCURRENCY: int = 8
+    # the folder to keep the ndjson report of each fleet action, empty to skip
+    FLEET_REPORT_DIR: str = ""
+    # the ssh connections kept open for reuse in the same process
+    SSH_POOL_SIZE: int = 64
+    SSH_POOL_IDLE_SECONDS: int = 300
+    # the decoded res documents kept in memory by each ServerRoom
+    RES_CACHE_SIZE: int = 512
+    # how long the collected host facts are trusted before probing the host again
+    FACTS_TTL_SECONDS: int = 3600
+    # the modules imported by the console before the dispatch, they add commands with util.register_command
+    COMMAND_PLUGINS: list = []
+    # the port scan snapshots kept for each server, 288 is one day of scans every 5 minutes
+    PORT_SNAPSHOT_KEEP: int = 288
+    # the folder of the downloaded cache backups, empty for WS_LOCAL/cache/server_backups
+    BACKUP_DIR: str = ""
+    # the bytes read in each request of the backup download
+    BACKUP_CHUNK_SIZE: int = 1024 * 1024
+    # the parallel sftp sessions of one host when a folder is synced
+    SYNC_WORKERS: int = 4
+    # the files from DELTA_MIN_SIZE bytes are patched block by block instead of uploaded whole
+    DELTA_BLOCK_SIZE: int = 512 * 1024
+    DELTA_MIN_SIZE: int = 4 * 1024 * 1024
+    # keep the raw docker inspect output in DATAPATH_BASE/command_prompt_tmp for debugging
+    DOCKER_INSPECT_DUMP: bool = False
+    # the vpn status command, a script with the same list, start and stop arguments can stand in for vpnutil
+    VPNUTIL: str = "vpnutil"
+    TUNNEL_COMMAND_TIMEOUT: int = 30
+    # the seconds to wait for a vpn profile to come up or go down
+    TUNNEL_UP_TIMEOUT: int = 60
+    TUNNEL_DOWN_TIMEOUT: int = 30
+    # the first and the longest wait between two status polls
+    TUNNEL_POLL_FIRST: float = 0.25
+    TUNNEL_POLL_MAX: float = 5.0
+    # how long a vpn status is trusted before asking vpnutil again
+    TUNNEL_STATUS_TTL: float = 5.0
+    # the l2tp/ipsec client, the connection name of ipsec.conf and xl2tpd.conf and the deadline of each phase
+    L2TP_CONNECTION_NAME: str = "XXX-YOUR-CONNECTION-NAME-XXX"
+    L2TP_SERVICE_TIMEOUT: int = 20
+    L2TP_IPSEC_TIMEOUT: int = 30
+    L2TP_PPP_TIMEOUT: int = 20
+    L2TP_LOGIN_ATTEMPTS: int = 6
+    # how many times the services are restarted when ipsec up fails
+    L2TP_IPSEC_ATTEMPTS: int = 3
+    # the pause before dialing again when the server refused the login
+    L2TP_RETRY_WAIT: int = 30
+    # the openssh ControlMaster sockets of the interactive logins, empty for DATAPATH_BASE/cm
+    CONTROL_PATH_DIR: str = ""
+    # how long an idle master connection stays open after the last session, in ssh time format
+    CONTROL_PERSIST: str = "30m"
+    # how many of the latest logged in servers the prewarm command opens masters for
+    PREWARM_COUNT: int = 5
+    # the ssh backend of the fleet jobs, fabric or asyncssh
+    SSH_BACKEND: str = "fabric"
+    # how many hosts the asyncssh backend keeps in flight on its event loop
+    ASYNC_CONCURRENCY: int = 200
+    ASYNC_CONNECT_TIMEOUT: int = 30
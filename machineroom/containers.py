@@ -0,0 +1,82 @@
+from typing import Union
+
+
+def published_ports(ports: Union[dict, None]) -> list[str]:
+    """
+    the NetworkSettings.Ports of docker inspect in the form of docker ps, e.g. 0.0.0.0:80->80/tcp
+    """
+    found = []
+    for container_port, bindings in (ports or {}).items():
+        for b in bindings or []:
+            found.append(f"{b.get('HostIp', '')}:{b.get('HostPort', '')}->{container_port}")
+    return found
+
+
+class ContainerRecord:
+    """
+    one container of a host, from docker inspect and optionally its docker ps line
+    """
+    id: str
+    name: str
+    image: str
+    state: str
+    status: str
+    ports: list[str]
+    networks: list[str]
+    labels: dict
+    created: str
+    started_at: str
+    restart_count: int
+    health: str
+
+    def __init__(self, inspect: dict, ps: dict = None):
+        ps = ps or {}
+        state = inspect.get("State", {}) or {}
+        config = inspect.get("Config", {}) or {}
+        network = inspect.get("NetworkSettings", {}) or {}
+        self.id = inspect.get("Id", ps.get("ID", ""))
+        self.name = ps.get("Names", inspect.get("Name", "").lstrip("/")).split(",")[0]
+        self.image = ps.get("Image", config.get("Image", ""))
+        self.state = ps.get("State", state.get("Status", ""))
+        self.status = ps.get("Status", state.get("Status", ""))
+        if "Ports" in ps:
+            self.ports = [p.strip() for p in ps["Ports"].split(",") if p.strip() != ""]
+        else:
+            self.ports = published_ports(network.get("Ports"))
+        self.networks = sorted(network.get("Networks", {}) or {})
+        self.labels = config.get("Labels", {}) or {}
+        self.created = inspect.get("Created", ps.get("CreatedAt", ""))
+        self.started_at = state.get("StartedAt", "")
+        self.restart_count = int(inspect.get("RestartCount", 0) or 0)
+        self.health = (state.get("Health") or {}).get("Status", "")
+        self._inspect = inspect
+
+    @property
+    def running(self) -> bool:
+        return self.state == "running"
+
+    @property
+    def inspect(self) -> dict:
+        """
+        the full docker inspect document of the container
+        """
+        return self._inspect
+
+    def to_dict(self) -> dict:
+        return {
+            "id": self.id,
+            "name": self.name,
+            "image": self.image,
+            "state": self.state,
+            "status": self.status,
+            "ports": self.ports,
+            "networks": self.networks,
+            "labels": self.labels,
+            "created": self.created,
+            "started_at": self.started_at,
+            "restart_count": self.restart_count,
+            "health": self.health,
+        }
+
+    def __repr__(self):
+        return f"<ContainerRecord {self.id[:12]} {self.name} {self.image} {self.state}>"
@@ -19,3 +19,15 @@ class FoundVPNTunnel(MachineRoomErr):
 
 class DockerAccessProblem(MachineRoomErr):
     ...
+
+
+class AsyncBackendMissing(MachineRoomErr):
+    ...
+
+
+class BackupFailed(MachineRoomErr):
+    ...
+
+
+class TunnelTimeout(MachineRoomErr):
+    ...
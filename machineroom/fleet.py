@@ -0,0 +1,189 @@
+import datetime
+import json
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Union
+
+
+class HostResult:
+    """
+    the outcome of one host inside a fleet run
+    """
+    index: int
+    server_id: str
+    host: str
+    ok: bool
+    value: object
+    error: Union[Exception, None]
+    started_at: float
+    duration: float
+    # what the host connection has run, see MeteredConnection
+    commands: int
+    stdout_bytes: int
+    stderr_bytes: int
+    exit_status: int
+
+    def __init__(self, index: int):
+        self.index = index
+        self.server_id = ""
+        self.host = ""
+        self.ok = False
+        self.value = None
+        self.error = None
+        self.started_at = time.time()
+        self.duration = 0.0
+        self.commands = 0
+        self.stdout_bytes = 0
+        self.stderr_bytes = 0
+        self.exit_status = 0
+
+    def begin(self, server_id: str, host: str):
+        self.server_id = server_id
+        self.host = host
+
+    def done(self, value=None):
+        self.ok = True
+        self.value = value
+        self.duration = time.time() - self.started_at
+
+    def fail(self, e: Exception):
+        self.ok = False
+        self.error = e
+        self.duration = time.time() - self.started_at
+
+    @property
+    def error_class(self) -> str:
+        return "" if self.error is None else type(self.error).__name__
+
+    def meter(self, c):
+        self.commands = getattr(c, "commands", 0)
+        self.stdout_bytes = getattr(c, "stdout_bytes", 0)
+        self.stderr_bytes = getattr(c, "stderr_bytes", 0)
+        self.exit_status = getattr(c, "exit_status", 0)
+
+    def to_dict(self) -> dict:
+        line = {
+            "index": self.index,
+            "server_id": self.server_id,
+            "host": self.host,
+            "status": "ok" if self.ok else "failed",
+            "started_at": round(self.started_at, 3),
+            "duration": round(self.duration, 3),
+            "commands": self.commands,
+            "stdout_bytes": self.stdout_bytes,
+            "stderr_bytes": self.stderr_bytes,
+            "exit_status": self.exit_status,
+            "error_class": self.error_class,
+            "error": "" if self.error is None else str(self.error),
+        }
+        # the plain values returned by the host callback go into the report too
+        if isinstance(self.value, (dict, list, str, int, float, bool)):
+            line["value"] = self.value
+        return line
+
+    def __repr__(self):
+        state = "ok" if self.ok else f"failed {self.error_class}"
+        return f"<HostResult #{self.index} {self.server_id} {self.host} {state} {self.duration:.2f}s>"
+
+
+def run_fleet(indexes: list[int], work: Callable[[int], HostResult], concurrency: int = 1) -> list[HostResult]:
+    """
+    run the work function for each server index, at most `concurrency` hosts at the same time.
+    the work function is responsible to catch its own errors into the HostResult.
+    """
+    if concurrency <= 1 or len(indexes) <= 1:
+        return [work(i) for i in indexes]
+    workers = min(concurrency, len(indexes))
+    with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="machineroom") as pool:
+        return list(pool.map(work, indexes))
+
+
+def print_summary(results: list[HostResult]):
+    failed = [r for r in results if r.ok is False]
+    print(f"======================== {len(results) - len(failed)}/{len(results)} hosts done.")
+    for r in failed:
+        print(f"  x {r.server_id} {r.host} -> {r.error_class}: {r.error}")
+
+
+class FleetReport:
+    """
+    the results of one fleet action over all its hosts
+    """
+    action: str
+    results: list[HostResult]
+
+    def __init__(self, action: str, results: list[HostResult]):
+        self.action = action
+        self.results = results
+
+    @property
+    def ok(self) -> list[HostResult]:
+        return [r for r in self.results if r.ok]
+
+    @property
+    def failed(self) -> list[HostResult]:
+        return [r for r in self.results if r.ok is False]
+
+    @property
+    def wall_time(self) -> float:
+        if len(self.results) == 0:
+            return 0.0
+        start = min([r.started_at for r in self.results])
+        end = max([r.started_at + r.duration for r in self.results])
+        return end - start
+
+    @property
+    def throughput(self) -> float:
+        """
+        hosts done per second
+        """
+        wall = self.wall_time
+        return len(self.results) / wall if wall > 0 else 0.0
+
+    def slowest(self, n: int = 5) -> list[HostResult]:
+        return sorted(self.results, key=lambda r: r.duration, reverse=True)[:n]
+
+    def to_dict(self) -> dict:
+        return {
+            "action": self.action,
+            "hosts": len(self.results),
+            "ok": len(self.ok),
+            "failed": len(self.failed),
+            "wall_time": round(self.wall_time, 3),
+            "throughput": round(self.throughput, 3),
+            "results": [r.to_dict() for r in self.results],
+        }
+
+    def to_json(self) -> str:
+        return json.dumps(self.to_dict(), indent=2)
+
+    def to_ndjson(self) -> str:
+        """
+        one line per host, each line also carries the action name
+        """
+        lines = []
+        for r in self.results:
+            line = {"action": self.action}
+            line.update(r.to_dict())
+            lines.append(json.dumps(line))
+        return "\n".join(lines) + "\n"
+
+    def save(self, path: str) -> str:
+        """
+        write the report to the file path, or into the folder path with a timestamped name.
+        the format is json for a .json file and ndjson otherwise.
+        """
+        if os.path.isdir(path):
+            stamp = datetime.datetime.now().strftime("%Y%m%d-%H%M%S")
+            path = os.path.join(path, f"{self.action}-{stamp}.ndjson")
+        with open(path, "w") as f:
+            f.write(self.to_json() if path.endswith(".json") else self.to_ndjson())
+        return path
+
+    def print_stats(self):
+        print(f"{self.action}: {len(self.ok)}/{len(self.results)} hosts in {self.wall_time:.1f}s "
+              f"({self.throughput:.2f} hosts/s)")
+        for r in self.slowest(3):
+            if r.duration > 0:
+                print(f"  slow {r.server_id} {r.host} {r.duration:.1f}s {r.commands} commands")
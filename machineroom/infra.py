@@ -1,14 +1,9 @@
 import pexpect
 
 from machineroom import taskbase as tb, __version__
+from machineroom.fleet import HostResult, print_summary
 from machineroom.tunnels.conn import *
 
-try:
-    import SQLiteAsJSON
-except:
-    os.system('python3.11 -m pip install SQLiteAsJSON')
-    import SQLiteAsJSON
-
 from machineroom import *
 
 execute_path = os.path.dirname(__file__)
@@ -43,21 +38,11 @@ class Infra2(tb.DeploymentBotFoundation):
         if len(self.running_arr) == 0:
             raise Exception("logic error, no server to start")
 
-    def run_conn_looper(self, callback_x=None):
+    def run_conn_looper(self, callback_x=None) -> list[HostResult]:
         self.serialize_checking()
-        for ser_i in self.running_arr:
-            self.srv.read_serv_at(ser_i)
-            self.stage_0()
-            c = self._est_connection()
-            try:
-                self.stage_1(c)
-                if callable(callback_x):
-                    callback_x(c)
-            except Exception as e:
-                if self.handle_exceptions(e, False):
-                    pass
-                raise e
+        results = self.run_hosts(self.running_arr, callback_x)
         self.run_tunnel_detection_off()
+        return results
 
 
 class Infra1(tb.DeploymentBotFoundation):
@@ -70,41 +55,36 @@ class Infra1(tb.DeploymentBotFoundation):
     def match_prefix_or_subfix(self, what: str) -> bool:
         return what in self.server_name
 
-    def run_conn(self, callback_x=None):
-        k = self.start_server_from
-        if self.srv.serv_count < k:
+    def run_conn(self, callback_x=None, indexes: list[int] = None) -> list[HostResult]:
+        if self.srv.serv_count < self.start_server_from:
             print("cannot start from out of range server number")
-            return
-        if self.run_tunnel_detection():
-            self.srv.use_next_node()
-            k += 1
-        while k < self.srv.serv_count:
-            self.stage_0()
-            c = self._est_connection()
-            try:
-                self.stage_1(c)
-                if callable(callback_x):
-                    callback_x(c)
-            except Exception as e:
-                if self.handle_exceptions(e, False):
-                    pass
-                raise e
-
-            self.srv.use_next_node()
-            k += 1
+            return []
+        if indexes is None:
+            indexes = self.fleet_indexes()
+        if len(indexes) == 0:
+            return []
+        self.run_tunnel_detection()
+        results = self.run_hosts(indexes, callback_x)
         self.run_tunnel_detection_off()
+        return results
 
-    def run_offline(self, call_job=None):
-        k = self.start_server_from
-        if self.srv.serv_count < k:
+    def run_offline(self, call_job=None) -> list[HostResult]:
+        if self.srv.serv_count < self.start_server_from:
             print("cannot start from out of range server number")
-            return
-        while k < self.srv.serv_count:
-            self.stage_0()
-            try:
-                if callable(call_job):
-                    call_job(self.srv.current_id)
-            except Exception as e:
-                self.connection_err(e, False)
-            self.srv.use_next_node()
-            k += 1
+            return []
+        results = []
+        with self.srv.local().batch():
+            for k in self.fleet_indexes():
+                result = HostResult(k)
+                try:
+                    self.srv.read_serv_at(k)
+                    result.begin(self.srv.current_id, self.srv.current_host)
+                    self.stage_0()
+                    value = call_job(self.srv.current_id) if callable(call_job) else None
+                    result.done(value)
+                except Exception as e:
+                    self.connection_err(e, False)
+                    result.fail(e)
+                results.append(result)
+        print_summary(results)
+        return results
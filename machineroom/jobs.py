@@ -0,0 +1,171 @@
+"""
+the fleet jobs of the console, imported only when a command needs the remote hosts
+"""
+import datetime
+import os
+
+from fabric import Connection
+
+from machineroom import taskbase as tb
+from machineroom.const import Config
+from machineroom.containers import ContainerRecord
+from machineroom.fleet import FleetReport
+from machineroom.infra import Infra1
+
+
+def import_indexes(srv, indexes: list[int], full: bool) -> list[int]:
+    """
+    the hosts to connect for the import, all of them with full or else only the new and changed lines
+    """
+    if full:
+        return indexes
+    changed = srv.changed_indexes(indexes)
+    print(f"{len(changed)} new or changed hosts, {len(indexes) - len(changed)} unchanged hosts skipped")
+    return changed
+
+
+def record_ports(srv, ports: list[int]) -> dict:
+    """
+    keep the port snapshot of the current server and print what changed since the previous scan
+    """
+    (opened, closed) = srv.local().record_port_scan(ports)
+    if len(opened) > 0 or len(closed) > 0:
+        print(f"ports of {srv.current_id}: opened {opened} closed {closed}")
+    return {"ports": ports, "opened": opened, "closed": closed}
+
+
+def record_containers(srv, containers: list[ContainerRecord]) -> dict:
+    srv.local().record_containers(containers)
+    running = len([k for k in containers if k.running])
+    return {"containers": len(containers), "running": running}
+
+
+class ServerDoorJob(Infra1):
+
+    def action_import(self, full: bool = False) -> FleetReport:
+        indexes = import_indexes(self.srv, self.fleet_indexes(), full)
+        return FleetReport("import", self.run_conn(self._mark_imported, indexes))
+
+    def _mark_imported(self, c: Connection):
+        self.srv.mark_imported()
+
+    def action_retire(self) -> FleetReport:
+        return FleetReport("retire", self.run_offline(self._retire_on_each_server))
+
+    def action_off_cert(self) -> FleetReport:
+        return FleetReport("off-cert", self.run_offline(self._action_off_cert))
+
+    def _retire_on_each_server(self, server_id: str):
+        self.srv.local().update_res_kv("retired", True)
+
+    def _action_off_cert(self, server_id: str):
+        self.srv.local().delete_res_kv("identity_cert_installed")
+
+    def action_scan_ports(self) -> FleetReport:
+        return FleetReport("scan-ports", self.run_conn(self._from_c_ports))
+
+    def _from_c_ports(self, c: Connection) -> dict:
+        return record_ports(self.srv, tb.list_all_open_ports(c))
+
+    def action_docker_scan(self) -> FleetReport:
+        return FleetReport("docker-scan", self.run_conn(self._from_c_containers))
+
+    def _from_c_containers(self, c: Connection) -> dict:
+        return record_containers(self.srv, tb.docker_inventory(c))
+
+    def action_backup(self) -> FleetReport:
+        return FleetReport("backup", self.run_conn(self._from_c_backup))
+
+    def _from_c_backup(self, c: Connection) -> dict:
+        stamp = datetime.datetime.now().strftime("%Y%m%d")
+        local_path = tb.safe_cache_backup(c, f"{self.srv.current_id}-{stamp}.db")
+        backup = {"path": local_path, "size": os.path.getsize(local_path), "at": self.srv.local().get_time_now()}
+        self.srv.local().update_res_kv("last_backup", backup)
+        return backup
+
+    def action_sync_folder(self, folder_name: str) -> FleetReport:
+        def sync(c: Connection) -> dict:
+            results = tb.sync_folder(c, folder_name)
+            changed = [k for k in results if k["action"] != "skip"]
+            return {"files": len(results), "changed": len(changed), "sent": sum([k["sent"] for k in changed])}
+
+        return FleetReport("sync-folder", self.run_conn(sync))
+
+    def action_add_custom_cert(self, name, pubkey_path) -> FleetReport:
+        """Add a custom certificate to servers and store the path."""
+        def certification(c: Connection):
+            if tb.detect_cert_signature(c, name) is False:
+                tb.copy_id(c, pubkey_path)
+                # Store custom cert metadata
+                self.srv.local().update_res_kv(f"custom_cert_{name}", True)
+                # Store the private key path (convert .pub to private key)
+                private_key_path = self._resolve_private_key_path(pubkey_path)
+                self.srv.local().set_local_cert_path(private_key_path)
+
+        return FleetReport("add-cert", self.run_conn(certification))
+
+    def _resolve_private_key_path(self, pubkey_path: str) -> str:
+        """
+        Convert public key path to private key path.
+        
+        Args:
+            pubkey_path: Path to public key (.pub file)
+        
+        Returns:
+            str: Path to corresponding private key
+        """
+        return pubkey_path.replace(".pub", "")
+
+    def action_remove_custom_cert(self, name) -> FleetReport:
+        def certification(c: Connection):
+            if tb.detect_cert_signature(c, name) is False:
+                self.srv.local().delete_res_kv(f"custom_cert_{name}")
+
+        return FleetReport("remove-cert", self.run_conn(certification))
+
+
+class AsyncServerDoorJob:
+    """
+    the import, scan-ports and docker-scan actions on the asyncssh backend, see Config.SSH_BACKEND
+    """
+
+    def __init__(self, server_room: str):
+        from machineroom.aio import AsyncDeploymentBotFoundation
+        self.bot = AsyncDeploymentBotFoundation(server_room)
+
+    @property
+    def srv(self):
+        return self.bot.srv
+
+    def fleet_indexes(self) -> list[int]:
+        return self.bot.fleet_indexes()
+
+    def action_import(self, full: bool = False) -> FleetReport:
+        indexes = import_indexes(self.bot.srv, self.bot.fleet_indexes(), full)
+        return FleetReport("import", self.bot.run_conn(self._mark_imported, indexes))
+
+    async def _mark_imported(self, c, srv):
+        srv.mark_imported()
+
+    def action_scan_ports(self) -> FleetReport:
+        return FleetReport("scan-ports", self.bot.run_conn(self._from_c_ports))
+
+    async def _from_c_ports(self, c, srv) -> dict:
+        from machineroom.aio import list_all_open_ports_async
+        return record_ports(srv, await list_all_open_ports_async(c))
+
+    def action_docker_scan(self) -> FleetReport:
+        return FleetReport("docker-scan", self.bot.run_conn(self._from_c_containers))
+
+    async def _from_c_containers(self, c, srv) -> dict:
+        from machineroom.aio import docker_inventory_async
+        return record_containers(srv, await docker_inventory_async(c))
+
+
+def door_job(server_room: str):
+    """
+    the fleet job of the room file on the backend chosen by Config.SSH_BACKEND
+    """
+    if Config.SSH_BACKEND == "asyncssh":
+        return AsyncServerDoorJob(server_room)
+    return ServerDoorJob(server_room)
@@ -0,0 +1,118 @@
+"""
+the interactive ssh logins through openssh ControlMaster sockets.
+the first login to a server keeps its authenticated master open for Config.CONTROL_PERSIST,
+the next logins open a new session on it without another key exchange.
+"""
+import glob
+import os
+import subprocess
+
+from machineroom.const import Config
+from machineroom.sql import ServerRoom
+
+
+def control_dir() -> str:
+    path = Config.CONTROL_PATH_DIR if Config.CONTROL_PATH_DIR != "" else os.path.join(Config.DATAPATH_BASE, "cm")
+    os.makedirs(path, mode=0o700, exist_ok=True)
+    return path
+
+
+def control_options() -> list[str]:
+    # %C is the hash of the host, port and user, short enough for the unix socket path limit
+    return [
+        "-o", "ControlMaster=auto",
+        "-o", f"ControlPath={os.path.join(control_dir(), '%C')}",
+        "-o", f"ControlPersist={Config.CONTROL_PERSIST}",
+    ]
+
+
+def ssh_target(local: ServerRoom) -> list[str]:
+    """
+    the ssh arguments of the current server, the port, the key, the jump host and user@host
+    """
+    cert_info = local.get_cert_info()
+    (h, u, p) = local.get_info()
+    args = []
+    if int(p) != 22:
+        args += ["-p", str(p)]
+    if cert_info["installed"] and cert_info["path"]:
+        args += ["-i", cert_info["path"]]
+    bastion = local.get_res_kv("bastion")
+    if bastion != "":
+        args += ["-J", bastion]
+    return args + [f"{u}@{h}"]
+
+
+def master_alive(target: list[str]) -> bool:
+    r = subprocess.run(["ssh", *control_options(), "-O", "check", *target], capture_output=True)
+    return r.returncode == 0
+
+
+def start_master(target: list[str]) -> bool:
+    """
+    open the master in the background without a session, only the servers with the key installed
+    can be warmed up since there is nobody to type a password
+    """
+    r = subprocess.run(
+        ["ssh", *control_options(), "-o", "BatchMode=yes", "-o", "ConnectTimeout=10", "-f", "-N", *target],
+        capture_output=True, stdin=subprocess.DEVNULL)
+    return r.returncode == 0
+
+
+def close_masters() -> int:
+    """
+    ask every master under the control path to exit, returns how many were closed
+    """
+    closed = 0
+    for socket_path in glob.glob(os.path.join(control_dir(), "*")):
+        r = subprocess.run(["ssh", "-o", f"ControlPath={socket_path}", "-O", "exit", "master"], capture_output=True)
+        if r.returncode == 0:
+            closed += 1
+        elif os.path.exists(socket_path):
+            # a socket left by a master that is gone
+            os.remove(socket_path)
+    return closed
+
+
+def jump(local: ServerRoom, server_id: str, vpn_on=None) -> int:
+    """
+    the interactive login to the server, over its master when there is a live one.
+    the vpn is brought up by vpn_on only when no master is there to reuse.
+    """
+    local.set_server_id(server_id)
+    target = ssh_target(local)
+    profile = local.get_tunnel_profile()
+    if profile != "" and local.get_res_kv("bastion") == "" and callable(vpn_on):
+        print(f"TUNNEL PROFILE: {profile}")
+        if master_alive(target) is False:
+            vpn_on(profile)
+    local.update_res_kv("jumped_at", local.get_time_now())
+    home_path = local.get_res_kv("home_path")
+    remote = [f"cd {home_path}; bash"] if home_path != "" else []
+    return subprocess.call(["ssh", *control_options(), "-t", *target, *remote])
+
+
+def prewarm(local: ServerRoom, count: int, vpn_on=None) -> list[str]:
+    """
+    open the masters of the latest logged in servers, each vpn profile they need is brought up once
+    """
+    warmed = []
+    profiles = set()
+    for server_id in local.recent_jumps(count):
+        local.set_server_id(server_id)
+        if local.is_cert_installed() is False:
+            print(f"{server_id} has no key installed, skipped")
+            continue
+        target = ssh_target(local)
+        if master_alive(target):
+            warmed.append(server_id)
+            continue
+        profile = local.get_tunnel_profile()
+        if profile != "" and local.get_res_kv("bastion") == "" and profile not in profiles and callable(vpn_on):
+            vpn_on(profile)
+            profiles.add(profile)
+        if start_master(target):
+            warmed.append(server_id)
+        else:
+            print(f"{server_id} master did not start")
+    return warmed
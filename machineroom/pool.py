@@ -0,0 +1,167 @@
+import atexit
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+from typing import Callable
+
+from fabric import Connection
+
+from machineroom.const import Config
+
+
+class _Pooled:
+    conn: Connection
+    signature: tuple
+    last_used: float
+    # the workers holding the connection now, it is never swept or evicted while above zero
+    refs: int
+    # replaced or dropped while in use, closed by the last release
+    retired: bool
+
+    def __init__(self, conn: Connection, signature: tuple):
+        self.conn = conn
+        self.signature = signature
+        self.last_used = time.time()
+        self.refs = 0
+        self.retired = False
+
+
+class ConnectionPool:
+    """
+    keeps the authenticated ssh connections by server id, so the later stages and actions
+    in the same process reuse the transport and the sftp session of the first connection.
+    """
+    # zero follows Config.SSH_POOL_SIZE and Config.SSH_POOL_IDLE_SECONDS
+    _max_size: int
+    _idle_timeout: int
+    # the pool of the gateways the connections run through, each pooled connection holds its gateway
+    gateways: "ConnectionPool"
+
+    def __init__(self, max_size: int = 0, idle_timeout: int = 0, gateways: "ConnectionPool" = None):
+        self._max_size = max_size
+        self._idle_timeout = idle_timeout
+        self.gateways = gateways
+        self._conns = OrderedDict()
+        self._retired = []
+        self._lock = threading.Lock()
+
+    @property
+    def max_size(self) -> int:
+        return self._max_size if self._max_size > 0 else Config.SSH_POOL_SIZE
+
+    @property
+    def idle_timeout(self) -> int:
+        return self._idle_timeout if self._idle_timeout > 0 else Config.SSH_POOL_IDLE_SECONDS
+
+    def acquire(self, server_id: str, signature: tuple, factory: Callable[[], Connection]) -> Connection:
+        """
+        check out the pooled connection of this server, or a new one from the factory, until release.
+        the signature is the (host, port, user) of the server, a changed signature replaces the connection.
+        """
+        with self._lock:
+            self._sweep()
+            item = self._conns.get(server_id)
+            if item is not None and (item.signature != signature or self.healthy(item.conn) is False):
+                self._drop(server_id)
+                item = None
+            if item is None:
+                item = _Pooled(factory(), signature)
+                self._conns[server_id] = item
+            item.refs += 1
+            item.last_used = time.time()
+            self._conns.move_to_end(server_id)
+            self._evict()
+            return item.conn
+
+    def release(self, c: Connection):
+        """
+        give back a connection of acquire, it is idle from now on
+        """
+        with self._lock:
+            for server_id, item in list(self._conns.items()) + [(None, k) for k in self._retired]:
+                if item.conn is not c:
+                    continue
+                item.refs = max(item.refs - 1, 0)
+                item.last_used = time.time()
+                if item.retired and item.refs == 0:
+                    self._retired.remove(item)
+                    self._close(item)
+                return
+
+    @contextmanager
+    def checkout(self, server_id: str, signature: tuple, factory: Callable[[], Connection]):
+        c = self.acquire(server_id, signature, factory)
+        try:
+            yield c
+        finally:
+            self.release(c)
+
+    def healthy(self, c: Connection) -> bool:
+        if c.transport is None:
+            # not opened yet, fabric connects on the first use
+            return True
+        if c.is_connected is False:
+            return False
+        try:
+            # the openssh keepalive, well formed for every server unlike a bare send_ignore
+            c.transport.global_request("keepalive@openssh.com", wait=False)
+        except Exception:
+            return False
+        return True
+
+    def close(self, server_id: str):
+        with self._lock:
+            self._drop(server_id)
+
+    def close_all(self):
+        with self._lock:
+            for server_id in list(self._conns.keys()):
+                self._drop(server_id)
+            for item in self._retired:
+                self._close(item)
+            self._retired = []
+
+    def __len__(self) -> int:
+        return len(self._conns)
+
+    def _sweep(self):
+        expired = time.time() - self.idle_timeout
+        for server_id in [k for k, v in self._conns.items() if v.refs == 0 and v.last_used < expired]:
+            self._drop(server_id)
+
+    def _evict(self):
+        # the least recently used idle connections go first, the ones in use are kept even above the size
+        idle = [k for k, v in self._conns.items() if v.refs == 0]
+        while len(self._conns) > self.max_size and len(idle) > 0:
+            self._drop(idle.pop(0))
+
+    def _drop(self, server_id: str):
+        item = self._conns.pop(server_id, None)
+        if item is None:
+            return
+        if item.refs > 0:
+            # a worker still runs on it, the release closes it
+            item.retired = True
+            self._retired.append(item)
+            return
+        self._close(item)
+
+    def _close(self, item: _Pooled):
+        try:
+            item.conn.close()
+        except Exception:
+            pass
+        gateway = getattr(item.conn, "gateway", None)
+        if self.gateways is not None and isinstance(gateway, Connection):
+            # the channel is gone, the bastion may go idle once no other connection holds it
+            self.gateways.release(gateway)
+
+
+# the bastions of the ssh tunnels by user@host:port, the hosts behind one bastion open their
+# direct-tcpip channels on its single authenticated transport
+GATEWAYS = ConnectionPool()
+CONNECTIONS = ConnectionPool(gateways=GATEWAYS)
+# the hosts are closed before the bastions they run through
+atexit.register(GATEWAYS.close_all)
+atexit.register(CONNECTIONS.close_all)
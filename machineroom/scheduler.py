@@ -0,0 +1,78 @@
+"""
+run one fleet action over many room files.
+the room files are grouped by their tunnel, each tunnel goes up once for its whole group
+and the room files of the group run at the same time.
+"""
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable
+
+from machineroom.const import TunnelType
+from machineroom.fleet import FleetReport
+from machineroom.tunnels.state import TUNNELS
+
+
+class RoomGroup:
+    """
+    the room files behind the same tunnel profile
+    """
+    tunnel_type: TunnelType
+    profile_name: str
+    jobs: list
+
+    def __init__(self, tunnel_type: TunnelType, profile_name: str):
+        self.tunnel_type = tunnel_type
+        self.profile_name = profile_name
+        self.jobs = []
+
+    @property
+    def has_tunnel(self) -> bool:
+        return self.tunnel_type != TunnelType.NO_TUNNEL
+
+    @property
+    def hosts(self) -> int:
+        return sum([len(job.fleet_indexes()) for job in self.jobs])
+
+    def run(self, action: Callable[[object], FleetReport], online: bool = True) -> list[FleetReport]:
+        if online and self.has_tunnel:
+            print(f"tunnel {self.profile_name} ({self.tunnel_type.name}): {len(self.jobs)} room files, {self.hosts} hosts")
+            if self.tunnel_type == TunnelType.SSH:
+                # no vpn to hold, the hosts share the pooled bastion connection
+                return self._run_jobs(action)
+            with TUNNELS.hold(self.profile_name):
+                return self._run_jobs(action)
+        return self._run_jobs(action)
+
+    def _run_jobs(self, action: Callable[[object], FleetReport]) -> list[FleetReport]:
+        if len(self.jobs) == 1:
+            return [action(self.jobs[0])]
+        with ThreadPoolExecutor(max_workers=len(self.jobs), thread_name_prefix="room") as pool:
+            return list(pool.map(action, self.jobs))
+
+
+def group_rooms(jobs: list) -> list[RoomGroup]:
+    """
+    the groups of the jobs by (tunnel type, profile), the rooms without a tunnel come first
+    so they never run while a vpn is up, then the tunnels in the order they first appear
+    """
+    groups = {}
+    for job in jobs:
+        key = (job.srv.tunnel_type, job.srv.profile_name if job.srv.has_tunnel() else "")
+        if key not in groups:
+            groups[key] = RoomGroup(*key)
+        groups[key].jobs.append(job)
+    return sorted(groups.values(), key=lambda g: g.has_tunnel)
+
+
+def run_rooms(room_files: list[str], action: Callable[[object], FleetReport], job_factory: Callable,
+              online: bool = True) -> FleetReport:
+    """
+    run the action on the job of each room file and merge the results into one report,
+    online=False for the actions that never connect to the hosts and need no tunnel
+    """
+    reports = []
+    for group in group_rooms([job_factory(room) for room in room_files]):
+        reports += group.run(action, online)
+    results = []
+    for report in reports:
+        results += report.results
+    return FleetReport(reports[0].action if len(reports) > 0 else "", results)
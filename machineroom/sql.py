@@ -1,17 +1,23 @@
 # !/usr/bin/env python
 # coding: utf-8
+import copy
 import datetime
 import sqlite3
-from typing import Tuple
+from collections import OrderedDict
+from contextlib import contextmanager
+from typing import Tuple, Union, TYPE_CHECKING
 
 from SQLiteAsJSON import ManageDB
 from SQLiteAsJSON.SQLiteAsJSON import db_logger
 import os.path
 import json
-from requests import Response
 
 from machineroom.const import Config
 
+if TYPE_CHECKING:
+    from requests import Response
+    from machineroom.containers import ContainerRecord
+
 
 class SqlDataNotFound(Exception):
     pass
@@ -46,11 +52,133 @@ def obj_to_string(update_config) -> str:
     return update_string
 
 
+class DocCache:
+    """
+    the decoded json columns by (table, row id, column), least recently used are dropped first.
+    the documents are copied in and out so the callers can change them freely.
+    """
+    size: int
+
+    def __init__(self, size: int):
+        self.size = size
+        self._docs = OrderedDict()
+
+    def get(self, key: tuple) -> Union[dict, None]:
+        doc = self._docs.get(key)
+        if doc is None:
+            return None
+        self._docs.move_to_end(key)
+        return copy.deepcopy(doc)
+
+    def put(self, key: tuple, doc: dict):
+        if self.size <= 0:
+            return
+        self._docs[key] = copy.deepcopy(doc)
+        self._docs.move_to_end(key)
+        while len(self._docs) > self.size:
+            self._docs.popitem(last=False)
+
+    def drop(self, key: tuple):
+        self._docs.pop(key, None)
+
+    def clear(self):
+        self._docs.clear()
+
+    def __len__(self) -> int:
+        return len(self._docs)
+
+
+# the row columns holding json documents
+DOC_COLUMNS = ("res", "next_action")
+
+
 class ToolDb(ManageDB):
     """
     modified blockchain db controller
     """
 
+    def __init__(self, *args, **kwargs):
+        # column updates waiting for the end of the batch, by (table, row id)
+        self._pending = {}
+        # other statements waiting for the end of the batch, in order
+        self._pending_sql = []
+        self._batch_depth = 0
+        self._docs = DocCache(Config.RES_CACHE_SIZE)
+        super().__init__(*args, **kwargs)
+
+    def _cache_columns(self, tbl: str, row_id: str, params: dict):
+        for column in DOC_COLUMNS:
+            if column in params:
+                try:
+                    self._docs.put((tbl, row_id, column), json.loads(params[column]))
+                except (TypeError, json.JSONDecodeError):
+                    self._docs.drop((tbl, row_id, column))
+
+    @contextmanager
+    def batch(self):
+        """
+        keep the row updates in memory during the block and write them in one transaction at the end.
+        the reads of res and next_action inside the block see the pending values.
+        the updates are written even when the block fails, as they record what was done on the server.
+        a failed write is rolled back and raised at the end of the block.
+        """
+        self._batch_depth += 1
+        try:
+            yield self
+        finally:
+            self._batch_depth -= 1
+            if self._batch_depth == 0:
+                self.flush()
+
+    def in_batch(self) -> bool:
+        return self._batch_depth > 0
+
+    def flush(self) -> int:
+        if len(self._pending) == 0 and len(self._pending_sql) == 0:
+            return 0
+        pending = dict(self._pending)
+        self._pending.clear()
+        statements = list(self._pending_sql)
+        self._pending_sql.clear()
+        try:
+            for (tbl, row_id), columns in pending.items():
+                sets = ", ".join([f"{k} = ?" for k in columns.keys()])
+                self.conn.execute(f"UPDATE {tbl} SET {sets} WHERE id = ?", (*columns.values(), row_id))
+                self._after_update(tbl, row_id, columns)
+            for (statement, params) in statements:
+                self.conn.execute(statement, params)
+            self.conn.commit()
+        except Exception as E:
+            self.conn.rollback()
+            # the documents of the batch were cached before they were written
+            self._docs.clear()
+            db_logger.error('Batch Update Error : %s', E)
+            # the status of the host was not written, the caller records the failure
+            raise
+        return len(pending) + len(statements)
+
+    def execute_write(self, statement: str, params: tuple = ()):
+        """
+        run the write statement now, or at the end of the batch in the same transaction as the row updates
+        """
+        if self.in_batch():
+            self._pending_sql.append((statement, params))
+            return
+        self.conn.execute(statement, params)
+        self.conn.commit()
+
+    def _after_update(self, tbl: str, row_id: str, params: dict):
+        """
+        called inside the transaction of each row update, before the commit
+        """
+        ...
+
+    def _pending_column(self, tbl: str, row_id: str, column: str):
+        columns = self._pending.get((tbl, row_id))
+        if columns is None:
+            return None
+        return columns.get(column)
+
     def found_table(self, tableName: str) -> bool:
         sqlStatement = f"SELECT name FROM sqlite_sequence WHERE type='table' AND name='{tableName}'"
         cursor = self.conn.cursor()
@@ -84,15 +212,24 @@ class ToolDb(ManageDB):
     def update_by_id(self, tbl: str, server_id: str, params: dict) -> bool:
         if self.has_id_in_tbl(tbl, server_id) is False:
             return False
+        if self.in_batch():
+            self._pending.setdefault((tbl, server_id), {}).update(params)
+            self._cache_columns(tbl, server_id, params)
+            return True
         try:
             columns = obj_to_string(params)
             # update query
             self.conn.execute(f"UPDATE {tbl} set {columns} where id='{server_id}'")
+            self._after_update(tbl, server_id, params)
         except Exception as E:
+            self.conn.rollback()
+            for column in DOC_COLUMNS:
+                self._docs.drop((tbl, server_id, column))
             db_logger.error('Data Update Error : ', E)
             return False
 
         self.conn.commit()
+        self._cache_columns(tbl, server_id, params)
         return True
 
     def insert_row_dat(self, tbl: str, params: dict) -> bool:
@@ -132,13 +269,21 @@ class ToolDb(ManageDB):
         return True
 
     def get_member_res(self, tbl: str, server_id: str) -> dict:
+        cached = self._docs.get((tbl, server_id, "res"))
+        if cached is not None:
+            return cached
+        pending = self._pending_column(tbl, server_id, "res")
+        if pending is not None:
+            return json.loads(pending)
         cursor = self.conn.cursor()
         try:
             cursor.execute(f'SELECT res FROM {tbl} WHERE id = ?', (server_id,))
             row = cursor.fetchone()
             if not row or row[0] in (None, ""):
                 return {}
-            return json.loads(row[0])
+            doc = json.loads(row[0])
+            self._docs.put((tbl, server_id, "res"), doc)
+            return doc
         except json.JSONDecodeError as e:
             db_logger.error("JSON decode error reading res for id %s: %s", server_id, e)
             return {}
@@ -172,6 +317,12 @@ class ToolDb(ManageDB):
         return data
 
     def get_next_action(self, tbl: str, server_id: str) -> dict:
+        cached = self._docs.get((tbl, server_id, "next_action"))
+        if cached is not None:
+            return cached
+        pending = self._pending_column(tbl, server_id, "next_action")
+        if pending is not None:
+            return json.loads(pending)
         cursor = self.conn.cursor()
         _da = {}
         next_action = None
@@ -182,6 +333,7 @@ class ToolDb(ManageDB):
         except Exception as E:
             db_logger.error('Data Insert Error : ', E)
         _da = json.loads(next_action)
+        self._docs.put((tbl, server_id, "next_action"), _da)
         return _da
 
     def get_time_now(self, future_seconds: int = 0) -> int:
@@ -210,7 +362,7 @@ class ToolDb(ManageDB):
         print(f"key {key} not exist. decision is OK.")
         return True
 
-    def keepcopy(self, file_path: str, r: Response):
+    def keepcopy(self, file_path: str, r: "Response"):
         try:
             with open(file_path, 'wb') as f:
                 for chunk in r.iter_content(chunk_size=8192):
@@ -223,6 +375,82 @@ class ToolDb(ManageDB):
 
 this_folder_path = os.path.dirname(__file__)
 
+# the schema changes applied to the existing cache.db, the position is the PRAGMA user_version after it
+MIGRATIONS = [
+    [
+        """CREATE TABLE IF NOT EXISTS server_status (
+            server_id char(100) NOT NULL,
+            component char(100) NOT NULL,
+            installed integer NOT NULL,
+            updated_at integer NOT NULL,
+            PRIMARY KEY (server_id, component))""",
+        "CREATE INDEX IF NOT EXISTS idx_server_status_component ON server_status (component, installed)",
+        """CREATE TABLE IF NOT EXISTS server_ports (
+            server_id char(100) NOT NULL,
+            port integer NOT NULL,
+            seen_at integer NOT NULL,
+            PRIMARY KEY (server_id, port))""",
+        "CREATE INDEX IF NOT EXISTS idx_server_ports_port ON server_ports (port)",
+    ],
+    [
+        """CREATE TABLE IF NOT EXISTS port_snapshots (
+            server_id char(100) NOT NULL,
+            taken_at integer NOT NULL,
+            ports text NOT NULL,
+            opened text NOT NULL,
+            closed text NOT NULL)""",
+        "CREATE INDEX IF NOT EXISTS idx_port_snapshots_server ON port_snapshots (server_id, taken_at)",
+    ],
+    [
+        """CREATE TABLE IF NOT EXISTS docker_containers (
+            server_id char(100) NOT NULL,
+            container_id char(64) NOT NULL,
+            name char(255) NOT NULL,
+            image char(255) NOT NULL,
+            state char(32) NOT NULL,
+            status char(255) NOT NULL,
+            ports text NOT NULL,
+            networks text NOT NULL,
+            labels text NOT NULL,
+            created char(64) NOT NULL,
+            started_at char(64) NOT NULL,
+            restart_count integer NOT NULL,
+            health char(32) NOT NULL,
+            scanned_at integer NOT NULL,
+            PRIMARY KEY (server_id, container_id))""",
+        "CREATE INDEX IF NOT EXISTS idx_docker_containers_name ON docker_containers (name)",
+        "CREATE INDEX IF NOT EXISTS idx_docker_containers_image ON docker_containers (image)",
+    ],
+]
+
+# the columns of docker_containers after server_id, in the order of the table
+CONTAINER_COLUMNS = ("container_id", "name", "image", "state", "status", "ports", "networks", "labels",
+                     "created", "started_at", "restart_count", "health", "scanned_at")
+
+
+def port_numbers(values) -> set:
+    """
+    the port numbers of the list, the entries that are not numbers are left out
+    """
+    ports = set()
+    for port in values or []:
+        try:
+            ports.add(int(port))
+        except (TypeError, ValueError):
+            continue
+    return ports
+
+
+# the install status shown in the fleet listing, label -> key in res
+STATUS_FLAGS = {
+    "retired": "retired",
+    "cert": "identity_cert_installed",
+    "docker": "docker_compose_installed",
+    "daed": "daed_installed",
+    "yacht": "yacht_installed",
+    "python": "python3_installed",
+}
+
 
 class ServerRoom(ToolDb):
     def __init__(self):
@@ -240,6 +468,7 @@ class ServerRoom(ToolDb):
             )
             if new_db:
                 self.create_table()
+            self.migrate()
             self.server_id = ""
         except sqlite3.OperationalError as eh:
             print("--err0--")
@@ -247,6 +476,206 @@ class ServerRoom(ToolDb):
             print(schema)
             print(eh)
 
+    def view(self) -> "ServerRoom":
+        """
+        another ServerRoom on the same db connection and cache with its own current server id
+        and its own batch, so the end of one view's batch never writes the half done batch of another
+        """
+        twin = copy.copy(self)
+        twin.server_id = ""
+        twin._pending = {}
+        twin._pending_sql = []
+        twin._batch_depth = 0
+        return twin
+
+    def migrate(self):
+        """
+        bring the existing cache.db up to the latest MIGRATIONS and fill the new tables from res
+        """
+        (version,) = self.conn.execute("PRAGMA user_version").fetchone()
+        if version >= len(MIGRATIONS):
+            return
+        for statements in MIGRATIONS[version:]:
+            for statement in statements:
+                self.conn.execute(statement)
+        for (server_id, res) in self.conn.execute(f"SELECT id, res FROM {self._tblembr}").fetchall():
+            try:
+                self._sync_status(server_id, json.loads(res) if res else {})
+            except json.JSONDecodeError:
+                continue
+        self.conn.execute(f"PRAGMA user_version = {len(MIGRATIONS)}")
+        self.conn.commit()
+
+    def _after_update(self, tbl: str, row_id: str, params: dict):
+        if tbl == self._tblembr and "res" in params:
+            self._sync_status(row_id, json.loads(params["res"]))
+
+    def _sync_status(self, server_id: str, res: dict):
+        """
+        mirror the flags and the ports of res into server_status and server_ports
+        """
+        now = self.get_time_now()
+        flags = [(server_id, k, 1 if v else 0, now) for k, v in res.items() if isinstance(v, bool)]
+        self.conn.execute(
+            f"DELETE FROM server_status WHERE server_id = ? AND component NOT IN ({','.join('?' * len(flags))})",
+            (server_id, *[f[1] for f in flags])
+        )
+        self.conn.executemany(
+            "INSERT INTO server_status (server_id, component, installed, updated_at) VALUES (?, ?, ?, ?) "
+            "ON CONFLICT (server_id, component) DO UPDATE SET installed = excluded.installed, "
+            "updated_at = CASE WHEN installed = excluded.installed THEN updated_at ELSE excluded.updated_at END",
+            flags
+        )
+        ports = port_numbers(res.get("ports", []))
+        # the ports still open keep the time they were first seen
+        self.conn.execute(
+            f"DELETE FROM server_ports WHERE server_id = ? AND port NOT IN ({','.join('?' * len(ports))})",
+            (server_id, *ports)
+        )
+        self.conn.executemany(
+            "INSERT OR IGNORE INTO server_ports (server_id, port, seen_at) VALUES (?, ?, ?)",
+            [(server_id, port, now) for port in ports]
+        )
+
+    def servers_with(self, component: str) -> list[str]:
+        cursor = self.conn.execute(
+            "SELECT server_id FROM server_status WHERE component = ? AND installed = 1 ORDER BY server_id",
+            (component,))
+        return [row[0] for row in cursor.fetchall()]
+
+    def servers_without(self, component: str) -> list[str]:
+        cursor = self.conn.execute(
+            f"SELECT id FROM {self._tblembr} WHERE id NOT IN "
+            "(SELECT server_id FROM server_status WHERE component = ? AND installed = 1) ORDER BY id",
+            (component,))
+        return [row[0] for row in cursor.fetchall()]
+
+    def servers_listening_on(self, port: int) -> list[str]:
+        cursor = self.conn.execute(
+            "SELECT server_id FROM server_ports WHERE port = ? ORDER BY server_id", (int(port),))
+        return [row[0] for row in cursor.fetchall()]
+
+    def port_index(self, port: int) -> list[dict]:
+        """
+        the servers listening on the port, with the host and the time the port was first seen open
+        """
+        cursor = self.conn.execute(
+            f"SELECT p.server_id, s.host, p.seen_at FROM server_ports p "
+            f"LEFT JOIN {self._tblembr} s ON s.id = p.server_id WHERE p.port = ? ORDER BY p.server_id",
+            (int(port),))
+        return [{"id": row[0], "host": row[1] or "", "seen_at": row[2]} for row in cursor.fetchall()]
+
+    def record_port_scan(self, ports: list) -> Tuple[list, list]:
+        """
+        keep the ports found on the current server as a new snapshot, returns the (opened, closed) ports
+        since the previous scan. the first scan of a server has nothing opened or closed.
+        """
+        now = self.get_time_now()
+        current = sorted(port_numbers(ports))
+        previous = self.get_res_kv("ports")
+        if isinstance(previous, list) and self.get_res_kv("ports_scanned_at") != "":
+            before = port_numbers(previous)
+            opened = [p for p in current if p not in before]
+            closed = sorted(before.difference(current))
+        else:
+            opened = []
+            closed = []
+        da = self.get_member_res(self._tblembr, self.server_id)
+        da.update({"ports": current, "ports_scanned_at": now})
+        self._update_server_meta(self.server_id, da)
+        self.execute_write(
+            "INSERT INTO port_snapshots (server_id, taken_at, ports, opened, closed) VALUES (?, ?, ?, ?, ?)",
+            (self.server_id, now, json.dumps(current), json.dumps(opened), json.dumps(closed)))
+        self.execute_write(
+            "DELETE FROM port_snapshots WHERE server_id = ? AND taken_at < "
+            "(SELECT taken_at FROM port_snapshots WHERE server_id = ? ORDER BY taken_at DESC LIMIT 1 OFFSET ?)",
+            (self.server_id, self.server_id, max(Config.PORT_SNAPSHOT_KEEP - 1, 0)))
+        return opened, closed
+
+    def record_containers(self, containers: list["ContainerRecord"]):
+        """
+        replace the container inventory of the current server with the scanned containers
+        """
+        now = self.get_time_now()
+        rows = []
+        for k in containers:
+            rows.append((
+                self.server_id, k.id, k.name, k.image, k.state, k.status,
+                json.dumps(k.ports), json.dumps(k.networks), json.dumps(k.labels),
+                k.created, k.started_at, k.restart_count, k.health, now,
+            ))
+        self.execute_write("DELETE FROM docker_containers WHERE server_id = ?", (self.server_id,))
+        for row in rows:
+            self.execute_write(
+                f"INSERT INTO docker_containers (server_id, {', '.join(CONTAINER_COLUMNS)}) "
+                f"VALUES ({', '.join('?' * (len(CONTAINER_COLUMNS) + 1))})", row)
+        da = self.get_member_res(self._tblembr, self.server_id)
+        da.update({"containers": len(rows), "containers_scanned_at": now})
+        self._update_server_meta(self.server_id, da)
+
+    def find_containers(self, keyword: str = "", state: str = "", server_id: str = "") -> list[dict]:
+        """
+        the containers of the last docker scans with the keyword in the name, the image or the labels
+        """
+        where = []
+        params = []
+        if keyword != "":
+            where.append("(c.name LIKE ? OR c.image LIKE ? OR c.labels LIKE ?)")
+            params += [f"%{keyword}%"] * 3
+        if state != "":
+            where.append("c.state = ?")
+            params.append(state)
+        if server_id != "":
+            where.append("c.server_id = ?")
+            params.append(server_id)
+        sql_where = "WHERE " + " AND ".join(where) if len(where) > 0 else ""
+        cursor = self.conn.execute(
+            f"SELECT c.server_id, s.host, c.{', c.'.join(CONTAINER_COLUMNS)} FROM docker_containers c "
+            f"LEFT JOIN {self._tblembr} s ON s.id = c.server_id {sql_where} ORDER BY c.server_id, c.name",
+            tuple(params))
+        found = []
+        for row in cursor.fetchall():
+            k = dict(zip(("server_id", "host") + CONTAINER_COLUMNS, row))
+            k["host"] = k["host"] or ""
+            for column in ("ports", "networks", "labels"):
+                k[column] = json.loads(k[column])
+            found.append(k)
+        return found
+
+    def port_history(self, server_id: str, limit: int = 20, changes_only: bool = False) -> list[dict]:
+        """
+        the latest port snapshots of the server, newest first
+        """
+        where = " AND (opened != '[]' OR closed != '[]')" if changes_only else ""
+        cursor = self.conn.execute(
+            f"SELECT taken_at, ports, opened, closed FROM port_snapshots WHERE server_id = ?{where} "
+            "ORDER BY taken_at DESC LIMIT ?", (server_id, int(limit)))
+        return [{
+            "taken_at": row[0],
+            "ports": json.loads(row[1]),
+            "opened": json.loads(row[2]),
+            "closed": json.loads(row[3]),
+        } for row in cursor.fetchall()]
+
+    def room_hashes(self) -> dict[str, str]:
+        """
+        the room file record hash of each server that was imported, see RoomFile.hash_at
+        """
+        cursor = self.conn.execute(
+            f"SELECT id, json_extract(res, '$.room_hash') FROM {self._tblembr} "
+            "WHERE json_valid(res) AND json_extract(res, '$.room_hash') IS NOT NULL")
+        return {row[0]: row[1] for row in cursor.fetchall()}
+
+    def recent_jumps(self, limit: int) -> list[str]:
+        """
+        the server ids of the latest interactive logins, the latest first
+        """
+        cursor = self.conn.execute(
+            f"SELECT id FROM {self._tblembr} "
+            "WHERE json_valid(res) AND json_extract(res, '$.jumped_at') IS NOT NULL "
+            "ORDER BY json_extract(res, '$.jumped_at') DESC LIMIT ?", (int(limit),))
+        return [row[0] for row in cursor.fetchall()]
+
     def check_df_ready(self) -> bool:
         return self._is_what_ready("df_management")
 
@@ -391,6 +820,73 @@ class ServerRoom(ToolDb):
         h = self.show_all_servers(self._tblembr)
         return h
 
+    def list_fleet(self, flags: list = None, keyword: str = "", sort: str = "id",
+                   limit: int = 0, offset: int = 0) -> list[dict]:
+        """
+        all servers with the status decoded in the same query.
+
+        Args:
+            flags: labels from STATUS_FLAGS the server must have, "!docker" for must not have
+            keyword: part of the server id or host
+            sort: "id", "host", "tunnel" or a label from STATUS_FLAGS, "-host" for descending
+            limit: the page size, 0 for all
+            offset: the rows to skip before the page
+        """
+        projection = ["id", "host",
+                      "IFNULL(json_extract(res, '$.tunnel_profile'), '')",
+                      "IFNULL(json_extract(res, '$.local_cert_path'), '')"]
+        projection += [f"IFNULL(json_extract(res, '$.{key}'), 0) = 1" for key in STATUS_FLAGS.values()]
+        where = []
+        params = []
+        for flag in flags or []:
+            negative = flag.startswith("!")
+            label = flag.lstrip("!")
+            if label not in STATUS_FLAGS:
+                raise ValueError(f"unknown status flag {label}, use one of {', '.join(STATUS_FLAGS.keys())}")
+            check = "EXISTS (SELECT 1 FROM server_status WHERE server_id = id AND component = ? AND installed = 1)"
+            where.append(f"NOT {check}" if negative else check)
+            params.append(STATUS_FLAGS[label])
+        if keyword != "":
+            where.append("(id LIKE ? OR host LIKE ?)")
+            params += [f"%{keyword}%", f"%{keyword}%"]
+
+        descending = sort.startswith("-")
+        sort = sort.lstrip("-")
+        if sort in ("id", "host"):
+            order = sort
+        elif sort == "tunnel":
+            order = "json_extract(res, '$.tunnel_profile')"
+        elif sort in STATUS_FLAGS:
+            order = f"IFNULL(json_extract(res, '$.{STATUS_FLAGS[sort]}'), 0)"
+        else:
+            raise ValueError(f"cannot sort by {sort}")
+
+        query = f"SELECT {', '.join(projection)} FROM {self._tblembr}"
+        if len(where) > 0:
+            query += " WHERE " + " AND ".join(where)
+        query += f" ORDER BY {order} {'DESC' if descending else 'ASC'}, id ASC"
+        if limit > 0:
+            query += " LIMIT ? OFFSET ?"
+            params += [limit, offset]
+
+        cursor = self.conn.cursor()
+        cursor.execute(query, params)
+        rows = cursor.fetchall()
+        cursor.close()
+        fleet = []
+        for row in rows:
+            (server_id, host, tunnel, cert_path) = row[:4]
+            item = {
+                "id": server_id,
+                "host": host,
+                "tunnel_profile": tunnel,
+                "cert_path": cert_path if cert_path != "" else os.path.expanduser("~/.ssh/id_rsa"),
+                "cert_is_default": cert_path == "",
+            }
+            item.update(zip(STATUS_FLAGS.keys(), [v == 1 for v in row[4:]]))
+            fleet.append(item)
+        return fleet
+
     def set_server_id(self, server_id: str):
         self.server_id = server_id
 
@@ -409,6 +905,28 @@ class ServerRoom(ToolDb):
         self._update_server_meta(self.server_id, da)
 
 
+    def get_facts(self, ttl_seconds: int) -> dict:
+        """
+        the collected host facts, empty when they are missing or older than ttl_seconds
+        """
+        facts = self.get_res_kv("facts")
+        if not isinstance(facts, dict) or "collected_at" not in facts:
+            return {}
+        if self.get_time_now() - facts["collected_at"] > ttl_seconds:
+            return {}
+        return facts
+
+    def update_facts(self, facts: dict):
+        facts = dict(facts)
+        facts["collected_at"] = self.get_time_now()
+        self.update_res_kv("facts", facts)
+
+    def forget_facts(self):
+        """
+        after an install on the host, the next read of the facts probes it again
+        """
+        self.update_res_kv("facts", {})
+
     def get_tunnel_profile(self):
         return self.get_res_kv("tunnel_profile")
 
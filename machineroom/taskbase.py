@@ -1,11 +1,33 @@
+import gzip
+import hashlib
+import io
 import os.path
+import shutil
+import posixpath
+import re
+import shlex
+import subprocess
+import tarfile
+import threading
+import uuid
+from concurrent.futures import ThreadPoolExecutor
 import pexpect
-from fabric import Config as FabricConfig, Result
+from fabric import Connection, Config as FabricConfig, Result
+from invoke import StreamWatcher, UnexpectedExit
+from machineroom.containers import ContainerRecord
+from machineroom.fleet import HostResult, run_fleet, print_summary
+from machineroom.pool import CONNECTIONS, GATEWAYS
 from machineroom.sql import ServerRoom
 from machineroom.tunnels import conn
 from machineroom.util import *
 
 
+class DummyWatcher(StreamWatcher):
+    def submit(self, stream):
+        # print(f'Output: "{stream}"')
+        return []
+
+
 def copy_id(c: Connection, file: str = Config.PUB_KEY):
     '''fab push 公钥 ssh-copy-id'''
     print("copy_id operation")
@@ -50,6 +72,74 @@ def docker_version_checker(r: Result):
         return False
 
 
+def docker_major_version(version: str) -> int:
+    """
+    the major number of a docker version such as 25.0.3, 0 when unknown
+    """
+    try:
+        return int(version.strip().split(".")[0])
+    except ValueError:
+        return 0
+
+
+def collect_facts(c: Connection) -> dict:
+    """
+    probe ram, disk, ip addresses, listening ports and the program paths of the host in one round trip
+    """
+    r = c.run(HOST_FACTS_PROBE, warn=True, hide=True, pty=False)
+    return parse_facts(r.stdout, r.stderr)
+
+
+def parse_facts(stdout: str, stderr: str = "") -> dict:
+    line = ""
+    for h in str(stdout).split("\n"):
+        if "__MR_FACTS__" in h:
+            line = h[h.index("__MR_FACTS__") + len("__MR_FACTS__"):].strip()
+    if line == "":
+        raise MachineRoomErr(f"cannot collect the host facts: {str(stderr).strip()}")
+    facts = json.loads(line)
+    facts["ram_gb"] = round(facts.get("ram_kb", 0) / 1024 / 1024, 2)
+    facts["disk_gb"] = round(facts.get("disk_kb", 0) / 1024 / 1024, 2)
+    facts["disk_free_gb"] = round(facts.get("disk_free_kb", 0) / 1024 / 1024, 2)
+    return facts
+
+
+def program_path(c: Connection, program: str) -> str:
+    """
+    the path of bash, docker or docker-compose on the host of this connection,
+    the Config default until apply_host_facts has found it
+    """
+    defaults = {"bash": Config.BASH, "docker": Config.DOCKER, "docker-compose": Config.DOCKER_COMPOSE}
+    programs = getattr(c, "programs", None) or {}
+    return programs.get(program, "") or defaults[program]
+
+
+def apply_host_facts(c: Connection, local: ServerRoom, facts: dict) -> bool:
+    """
+    keep the program paths from the facts on the connection of the host and mark the installed programs.
+    returns True when docker is older than version 25 and may need an upgrade.
+    """
+    paths = facts.get("paths", {})
+    # per host, the hosts of a fleet run at the same time and may have their programs in other places
+    c.programs = {k: paths.get(k, "") for k in ("bash", "docker", "docker-compose")}
+    below_25 = False
+    if paths.get("docker", "") != "":
+        if facts.get("docker_version", "") == "":
+            raise DockerAccessProblem("docker is not installed or may have permission problem")
+        if docker_major_version(facts["docker_version"]) >= 25:
+            print("The base version is 25 or above")
+            local.docker_ce_install()
+        else:
+            print("The base version is below 25")
+            if paths.get("docker-compose", "") != "":
+                local.docker_compose_install()
+            below_25 = True
+
+    if paths.get("daed", "") != "":
+        local.dae_install()
+    return below_25
+
+
 def ensure_path_exist(c: Connection, path: str) -> bool:
     if exists(c, path) is False:
         print(f"make path for {path}")
@@ -59,17 +149,13 @@ def ensure_path_exist(c: Connection, path: str) -> bool:
 
 
 def upload_what_file(c: Connection, folder_name: str, cache_file_name: str, if_not_exist: bool):
-    remote_path = os.path.join(Config.REMOTE_WS, folder_name, cache_file_name)
+    remote_path = posixpath.join(Config.REMOTE_WS, folder_name, cache_file_name)
     local_path = os.path.join(Config.WS_LOCAL, folder_name, cache_file_name)
-    if if_not_exist is True:
-        if exists(c, remote_path) is False:
-            c.put(local_path, remote_path)
-    else:
-        c.put(local_path, remote_path)
+    sync_files(c, [(local_path, remote_path)], if_not_exist)
 
 
 def upload_what_file_modify(c: Connection, folder_name: str, cache_file_name: str, modifier, if_not_exist: bool):
-    remote_path = os.path.join(Config.REMOTE_WS, folder_name, cache_file_name)
+    remote_path = posixpath.join(Config.REMOTE_WS, folder_name, cache_file_name)
     local_path = os.path.join(Config.WS_LOCAL, folder_name, cache_file_name)
     local_mod_path = os.path.join(Config.WS_LOCAL, folder_name, "mod_" + cache_file_name)
 
@@ -84,14 +170,153 @@ def upload_what_file_modify(c: Connection, folder_name: str, cache_file_name: st
         io.close()
 
     if os.path.isfile(local_mod_path):
-        if if_not_exist is True:
-            if exists(c, remote_path) is False:
-                c.put(local_mod_path, remote_path)
-        else:
-            c.put(local_mod_path, remote_path)
+        sync_files(c, [(local_mod_path, remote_path)], if_not_exist)
         os.remove(local_mod_path)
 
 
+def sync_folder(c: Connection, folder_name: str, workers: int = 0) -> list[dict]:
+    """
+    sync the local folder WS_LOCAL/folder_name to REMOTE_WS/folder_name, only the new and changed files are sent
+    """
+    local_root = os.path.join(Config.WS_LOCAL, folder_name)
+    if os.path.isdir(local_root) is False:
+        raise MachineRoomErr(f"there is no local folder {local_root}")
+    files = []
+    for root, dirs, names in os.walk(local_root):
+        dirs.sort()
+        for name in sorted(names):
+            local_path = os.path.join(root, name)
+            relative = os.path.relpath(local_path, local_root).replace(os.sep, "/")
+            files.append((local_path, posixpath.join(Config.REMOTE_WS, folder_name, relative)))
+    return sync_files(c, files, workers=workers)
+
+
+def sync_files(c: Connection, files: list[tuple[str, str]], if_not_exist: bool = False, workers: int = 0) -> list[dict]:
+    """
+    upload the (local path, remote path) pairs that differ from the remote files.
+    one round trip compares the sha256 of all the files, the large changed files only get their changed blocks,
+    and the uploads run on parallel sftp sessions of the same connection.
+    with if_not_exist the existing remote files are left as they are.
+    """
+    if len(files) == 0:
+        return []
+    wanted = {remote: "-" if if_not_exist else file_sha256(local) for (local, remote) in files}
+    states = remote_sync_probe(c, wanted)
+    jobs = []
+    results = []
+    for (local, remote) in files:
+        state = states.get(remote, {"state": "missing", "size": 0, "blocks": []})
+        if state["state"] in ("same", "present"):
+            results.append({"path": remote, "action": "skip", "sent": 0})
+        else:
+            jobs.append((local, remote, state))
+    workers = min(workers if workers > 0 else Config.SYNC_WORKERS, len(jobs))
+    if workers <= 1:
+        results += [sync_one_file(c, c.sftp(), *job) for job in jobs]
+    else:
+        lock = threading.Lock()
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            for done in [pool.submit(_sync_worker, c, jobs, lock) for _ in range(workers)]:
+                results += done.result()
+    sent = sum([k["sent"] for k in results])
+    changed = len([k for k in results if k["action"] != "skip"])
+    print(f"sync {changed} of {len(results)} files to {c.host}, {sent} bytes sent")
+    return results
+
+
+def _sync_worker(c: Connection, jobs: list, lock: threading.Lock) -> list[dict]:
+    # each worker has its own sftp channel on the shared ssh transport
+    results = []
+    c.open()
+    sftp = c.client.open_sftp()
+    try:
+        while True:
+            with lock:
+                if len(jobs) == 0:
+                    return results
+                job = jobs.pop(0)
+            results.append(sync_one_file(c, sftp, *job))
+    finally:
+        sftp.close()
+
+
+def remote_sync_probe(c: Connection, wanted: dict) -> dict:
+    """
+    the state of each remote path against the local sha256, - for only checking that the file is there
+    """
+    probe = REMOTE_SYNC_PROBE.replace("_BLOCK_SIZE_", str(Config.DELTA_BLOCK_SIZE))
+    probe = probe.replace("_MIN_SIZE_", str(Config.DELTA_MIN_SIZE))
+    lines = "".join([f"{want} {remote}\n" for (remote, want) in wanted.items()])
+    r = c.run(probe, in_stream=io.StringIO(lines), warn=True, hide=True, pty=False)
+    if r.failed:
+        raise MachineRoomErr(f"cannot compare the remote files: {r.stderr.strip()}")
+    return parse_sync_probe(r.stdout)
+
+
+def parse_sync_probe(stdout: str) -> dict:
+    states = {}
+    current = None
+    for line in stdout.split("\n"):
+        line = line.rstrip("\r")
+        if line.startswith("__MR_SUM__ "):
+            (state, size, path) = line[len("__MR_SUM__ "):].split(" ", 2)
+            current = {"state": state, "size": int(size), "blocks": []}
+            states[path] = current
+        elif line.startswith("__MR_BLOCK__ ") and current is not None:
+            current["blocks"].append(line.split(" ")[2])
+    return states
+
+
+def block_sums(local_path: str, block_size: int) -> list[str]:
+    sums = []
+    with open(local_path, "rb") as f:
+        for block in iter(lambda: f.read(block_size), b""):
+            sums.append(hashlib.sha256(block).hexdigest())
+    return sums
+
+
+def sync_one_file(c: Connection, sftp, local_path: str, remote_path: str, state: dict) -> dict:
+    if state["state"] == "changed" and len(state["blocks"]) > 0:
+        sent = delta_upload(c, sftp, local_path, remote_path, state["blocks"])
+        if sent >= 0:
+            return {"path": remote_path, "action": "delta", "sent": sent}
+    sftp.put(local_path, remote_path)
+    return {"path": remote_path, "action": "full", "sent": os.path.getsize(local_path)}
+
+
+def delta_upload(c: Connection, sftp, local_path: str, remote_path: str, remote_blocks: list[str]) -> int:
+    """
+    patch a copy of the remote file with the blocks that differ from the local file and move it in place
+    once its sha256 matches, returns the bytes sent or -1 when the patched copy does not match.
+    """
+    block_size = Config.DELTA_BLOCK_SIZE
+    local_blocks = block_sums(local_path, block_size)
+    size = os.path.getsize(local_path)
+    tmp = f"{remote_path}.mr_delta"
+    c.run(f"cp -p {shlex.quote(remote_path)} {shlex.quote(tmp)}", hide=True, pty=False)
+    sent = 0
+    with open(local_path, "rb") as lf, sftp.open(tmp, "r+b") as rf:
+        for (i, digest) in enumerate(local_blocks):
+            if i < len(remote_blocks) and remote_blocks[i] == digest:
+                continue
+            lf.seek(i * block_size)
+            block = lf.read(block_size)
+            rf.seek(i * block_size)
+            rf.write(block)
+            sent += len(block)
+        rf.truncate(size)
+    want = file_sha256(local_path)
+    r = c.run(
+        f'[ "$(sha256sum {shlex.quote(tmp)} | awk \'{{print $1}}\')" = "{want}" ] && mv -f {shlex.quote(tmp)} {shlex.quote(remote_path)}'
+        f' || {{ rm -f {shlex.quote(tmp)}; exit 9; }}',
+        warn=True, hide=True, pty=False
+    )
+    if r.failed:
+        print(f"the delta of {remote_path} does not match, upload the whole file")
+        return -1
+    return sent
+
+
 def upload_cache_file(c: Connection, cache_file_name: str, if_not_exist: bool = False):
     upload_what_file(c, "cache", cache_file_name, if_not_exist)
 
@@ -182,15 +407,25 @@ def detect_available_ports(c: Connection) -> list:
     return ports
 
 
-def list_all_open_ports(c: Connection) -> list:
-    r = c.run("sudo ss -tuln | grep LISTEN | awk '{print $5}' | cut -d: -f2", pty=False, warn=True)
-    before = r.stdout.strip()
-    if before == "":
-        return []
-    else:
-        k = str(before).split("\n")
-        port_list = list(set(k))
-        return port_list
+# the listening tcp ports, the port is after the last colon so the ipv6 addresses like [::]:22 are read too
+# ss runs first on its own, its failure would be lost in the exit status of the pipe
+LIST_PORTS = "ports=$(sudo ss -tuln) || exit $?; echo \"$ports\" | grep LISTEN | awk '{print $5}' | sed 's/.*://'"
+
+
+def parse_ports(stdout: str) -> list[int]:
+    ports = set()
+    for line in stdout.split("\n"):
+        line = line.strip()
+        if line.isdigit():
+            ports.add(int(line))
+    return sorted(ports)
+
+
+def list_all_open_ports(c: Connection) -> list[int]:
+    r = c.run(LIST_PORTS, pty=False, warn=True)
+    if r.failed:
+        raise MachineRoomErr(f"cannot list the open ports: {r.stderr.strip()}")
+    return parse_ports(r.stdout)
 
 
 def run_context(c: Connection, block: str) -> Result:
@@ -209,12 +444,24 @@ def exec_shell_global(c: Connection, _program_: str):
     return exec_shell_program(c, Config.SYSTEM_TEMP, _program_)
 
 
+def put_content(c: Connection, content: Union[str, bytes], remote_file: str):
+    """
+    upload the content from memory to the remote file
+    """
+    if isinstance(content, str):
+        content = content.encode("utf-8")
+    c.put(io.BytesIO(content), remote_file)
+
+
 def exec_shell_program(c: Connection, remote_path: str, _program_: str) -> Result:
-    buffer_file = BufferFile()
-    buffer_file.new_bash()
-    buffer_file.add_cmd(_program_)
-    c.put(buffer_file.path, remote_path)
-    return exec_shell(c, remote_path, buffer_file.execution_cmd)
+    """
+    upload the program as a bash script with a unique name, run it in remote_path and remove it again,
+    so the hosts running at the same time never share a script file.
+    """
+    script_name = f"mr_{uuid.uuid4().hex}.sh"
+    put_content(c, f"#!/bin/bash\n{_program_}\n", posixpath.join(remote_path, script_name))
+    cmd0 = f'cd {remote_path} && {program_path(c, "bash")} {script_name}; mr_status=$?; rm -f {script_name}; exit $mr_status'
+    return c.run(cmd0, pty=True, timeout=3000, warn=True)
 
 
 def exec_shell_program_file(c: Connection, remote_path: str, program_file: BufferFile) -> Result:
@@ -223,7 +470,7 @@ def exec_shell_program_file(c: Connection, remote_path: str, program_file: Buffe
 
 
 def exec_shell(c: Connection, working_path: str, bash_file: str, empty_content_after_execution: bool = False) -> Result:
-    cmd0 = f'cd {working_path} && {Config.BASH} {bash_file}'
+    cmd0 = f'cd {working_path} && {program_path(c, "bash")} {bash_file}'
     cmd1 = f'cd {working_path} && echo "" > {bash_file}'
     result = c.run(cmd0, pty=True, timeout=3000, warn=True)
     if result.ok and empty_content_after_execution:
@@ -232,38 +479,132 @@ def exec_shell(c: Connection, working_path: str, bash_file: str, empty_content_a
 
 
 # Back up related commands
-def safe_cache_backup(c: Connection, local_file_name: str):
-    """
-    safely backup the working cache file in the remote server
-    download the gz db to local
-    """
-    original_rm = os.path.join(Config.REMOTE_WS, "cache", "cache.db")
-    remote_path = os.path.join(Config.REMOTE_WS, "cache", local_file_name)
-    t = BACKUP_CACHE_FAST.replace("_CFP_", original_rm).replace("_FR_", local_file_name)
-    exec_shell_program(c, "/tmp", t)
-    local_path = os.path.join(Config.WS_LOCAL, "cache", "server_backups", local_file_name)
-    c.get(remote_path, local_path)
-    print("Download successful")
+def backup_dir() -> str:
+    return Config.BACKUP_DIR if Config.BACKUP_DIR != "" else os.path.join(Config.WS_LOCAL, "cache", "server_backups")
+
+
+def safe_cache_backup(c: Connection, local_file_name: str) -> str:
+    """
+    safely backup the working cache file in the remote server with the sqlite online backup,
+    compress it there and download it in chunks, a broken download resumes from the .part file on the next call.
+    returns the local path of the compressed backup, see open_backup_cache_local
+    """
+    original_rm = posixpath.join(Config.REMOTE_WS, "cache", "cache.db")
+    remote_path = posixpath.join(Config.REMOTE_WS, "cache", local_file_name)
+    os.makedirs(backup_dir(), exist_ok=True)
+    local_base = os.path.join(backup_dir(), local_file_name)
+    reuse = "1" if len(backup_parts(local_base)) > 0 else "0"
+    t = BACKUP_CACHE_SNAPSHOT.replace("_CFP_", original_rm).replace("_OUT_", remote_path).replace("_REUSE_", reuse)
+    r = c.run(t, warn=True, hide=True, pty=False)
+    meta = parse_backup_meta(r.stdout, r.stderr)
+    suffix = ".zst" if meta["codec"] == "zstd" else ".gz"
+    local_path = local_base + suffix
+    part = f"{local_base}.{meta['sha256'][:16]}.part"
+    # the parts of an older remote copy cannot be resumed
+    for stale in backup_parts(local_base):
+        if stale != part:
+            os.remove(stale)
+    download_resumable(c, meta["path"], part, meta["size"])
+    if file_sha256(part) != meta["sha256"]:
+        os.remove(part)
+        raise BackupFailed(f"the checksum of {local_file_name} does not match, the download is dropped")
+    os.replace(part, local_path)
+    c.run(f'rm -f "{remote_path}" "{meta["path"]}" "{remote_path}.meta"', warn=True, hide=True, pty=False)
+    print(f"Download successful {local_path} {meta['size']} bytes ({meta['method']}, {meta['codec']})")
     return local_path
 
 
+def parse_backup_meta(stdout: str, stderr: str = "") -> dict:
+    for h in str(stdout).split("\n"):
+        if "__MR_BACKUP__" in h:
+            return json.loads(h[h.index("__MR_BACKUP__") + len("__MR_BACKUP__"):].strip())
+    raise BackupFailed(f"cannot backup the cache: {str(stderr).strip()}")
+
+
+def backup_parts(local_base: str) -> list[str]:
+    (p, f) = os.path.split(local_base)
+    if os.path.isdir(p) is False:
+        return []
+    return [os.path.join(p, n) for n in os.listdir(p) if n.startswith(f + ".") and n.endswith(".part")]
+
+
+def download_resumable(c: Connection, remote_path: str, part: str, size: int):
+    """
+    download the remote file into the part file in chunks, starting after the bytes the part file already has
+    """
+    offset = os.path.getsize(part) if os.path.exists(part) else 0
+    if offset > size:
+        os.remove(part)
+        offset = 0
+    if offset == size:
+        return
+    sftp = c.sftp()
+    try:
+        rf = sftp.open(remote_path, "rb")
+    except IOError as e:
+        # the remote copy is gone, its part file can never be completed
+        if os.path.exists(part):
+            os.remove(part)
+        raise BackupFailed(f"cannot open {remote_path}: {e}")
+    with rf, open(part, "ab") as lf:
+        rf.seek(offset)
+        rf.prefetch(size - offset)
+        while offset < size:
+            chunk = rf.read(min(Config.BACKUP_CHUNK_SIZE, size - offset))
+            if len(chunk) == 0:
+                raise BackupFailed(f"the download of {remote_path} stopped at {offset} of {size} bytes")
+            lf.write(chunk)
+            offset += len(chunk)
+
+
+def file_sha256(path: str) -> str:
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1024 * 1024), b""):
+            h.update(block)
+    return h.hexdigest()
+
+
 def open_backup_cache_local(local_path) -> str:
     """
-    the final local path of the cache file backup
+    the final local path of the cache file backup, decompressed next to the downloaded file
     """
-    local_fz = os.path.join(Config.WS_LOCAL, "cache", "server_backups", "cache.db")
     (p, f) = os.path.split(local_path)
-    # local_compressed = os.path.join(WS_LOCAL, "cache", local_file_name)
-    # local_fz = os.path.join(WS_LOCAL, "cache", local_file_name.replace(".tar.gz", ""))
-    # db_name_x = f.replace(".tar.gz", "")
-    # local_pd = os.path.join(WS_LOCAL, "cache")
-    local_cmd = f'cd {p} && tar -xvf {f}'
-    print(local_cmd)
-    os.system(local_cmd)
-    # os.renames("cache.db", db_name_x)
-    os.chdir(Config.WS_LOCAL)
-    # return os.path.join(p, db_name_x)
-    return local_fz
+    if f.endswith(".tar.gz"):
+        # the archives of the older backups hold cache.db
+        with tarfile.open(local_path, "r:gz") as tar:
+            if hasattr(tarfile, "data_filter"):
+                tar.extractall(path=p, filter="data")
+            else:
+                tar.extractall(path=p)
+        return os.path.join(p, "cache.db")
+    if f.endswith(".gz"):
+        target = local_path[:-len(".gz")]
+        with gzip.open(local_path, "rb") as src, open(target + ".tmp", "wb") as dst:
+            shutil.copyfileobj(src, dst, 1024 * 1024)
+    elif f.endswith(".zst"):
+        target = local_path[:-len(".zst")]
+        zstd_decompress(local_path, target + ".tmp")
+    else:
+        return local_path
+    os.replace(target + ".tmp", target)
+    return target
+
+
+def zstd_decompress(source: str, target: str):
+    try:
+        import zstandard
+    except ImportError:
+        zstandard = None
+    if zstandard is not None:
+        with open(source, "rb") as src, open(target, "wb") as dst:
+            zstandard.ZstdDecompressor().copy_stream(src, dst)
+        return
+    # without the zstandard package the zstd program decompresses the stream
+    with open(target, "wb") as dst:
+        r = subprocess.run(["zstd", "-d", "-c", "-q", source], stdout=dst, stderr=subprocess.PIPE)
+    if r.returncode != 0:
+        raise BackupFailed(f"cannot decompress {source}, install zstandard or zstd: {r.stderr.decode().strip()}")
 
 
 # Docker related commands in library
@@ -272,14 +613,14 @@ def exec_docker_compose(c: Connection, working_path: str, yml_file: str, upgrade
     cmd0 = f"cd {working_path} &&"
     if yml_file == "docker-compose.yml":
         if upgrade:
-            cmd0 = cmd0 + f"{Config.DOCKER_COMPOSE} pull &&"
-        cmd1 = cmd0 + f'{Config.DOCKER_COMPOSE} up -d'
+            cmd0 = cmd0 + f"{program_path(c, 'docker-compose')} pull &&"
+        cmd1 = cmd0 + f'{program_path(c, "docker-compose")} up -d'
         if upgrade:
             cmd1 = cmd1 + ' --force-recreate'
     else:
         if upgrade:
-            cmd0 = cmd0 + f"{Config.DOCKER_COMPOSE} pull &&"
-        cmd1 = cmd0 + f'{Config.DOCKER_COMPOSE} -f {yml_file} up -d'
+            cmd0 = cmd0 + f"{program_path(c, 'docker-compose')} pull &&"
+        cmd1 = cmd0 + f'{program_path(c, "docker-compose")} -f {yml_file} up -d'
         if upgrade:
             cmd1 = cmd1 + ' --force-recreate'
 
@@ -287,19 +628,11 @@ def exec_docker_compose(c: Connection, working_path: str, yml_file: str, upgrade
 
 
 def stop_rm_container(c: Connection, container_name: str):
-    cmd_line_go1 = DOCKER_STOP_CONTAIN_NAME.format(
-        COMMAND_DOCKER=Config.DOCKER,
-        CONTAINER_NAME=container_name
-    )
-    cmd_line_go2 = DOCKER_RM_NAME_BASED.format(
-        COMMAND_DOCKER=Config.DOCKER,
+    cmd_line_go = DOCKER_STOP_RM_NAME_BASED.format(
+        COMMAND_DOCKER=program_path(c, "docker"),
         CONTAINER_NAME=container_name
     )
-    buf_fi = BufferFile()
-    buf_fi.new_bash()
-    buf_fi.add_cmd(cmd_line_go1)
-    buf_fi.add_cmd(cmd_line_go2)
-    exec_shell_program_file(c, "/tmp", buf_fi)
+    return c.run(cmd_line_go, pty=False, timeout=1900, warn=True, echo=True)
 
 
 def docker_is_container_conflict(rs: Result):
@@ -315,12 +648,11 @@ def docker_is_container_conflict(rs: Result):
 
 
 def docker_solve_conflict(c: Connection, hash: str):
-    c.run(DOCKER_STOP_ID.format(CID=hash, COMMAND_DOCKER=Config.DOCKER), pty=True, timeout=100, warn=True, echo=True)
-    c.run(DOCKER_STOP_RM.format(CID=hash, COMMAND_DOCKER=Config.DOCKER), pty=True, timeout=100, warn=True, echo=True)
+    docker_stop_rm_containers(c, [hash], timeout=200)
 
 
 def docker_get_container_ids_by_keyword(c: Connection, keyword: str) -> list:
-    command = '__DOCKER__ ps -aqf "name=^______"'.replace('______', keyword).replace('__DOCKER__', Config.DOCKER)
+    command = '__DOCKER__ ps -aqf "name=^______"'.replace('______', keyword).replace('__DOCKER__', program_path(c, "docker"))
     r = c.run(command, pty=True, timeout=1900, hide=True, warn=True, echo=False)
     reblock = r.stdout.replace("\r", "")
     ids = reblock.split('\n')
@@ -332,6 +664,60 @@ def docker_get_container_ids_by_keyword(c: Connection, keyword: str) -> list:
     return container__ids
 
 
+def docker_inventory(c: Connection) -> list[ContainerRecord]:
+    """
+    all the containers of the host with their inspect details, in one round trip
+    """
+    r = c.run(DOCKER_INVENTORY_PROBE.replace("COMMAND_DOCKER", program_path(c, "docker")), warn=True, hide=True, pty=False)
+    return parse_docker_inventory(r.stdout, r.stderr)
+
+
+def parse_docker_inventory(stdout: str, stderr: str = "") -> list[ContainerRecord]:
+    text = str(stdout).replace("\r", "")
+    if "__MR_PS__" not in text or "__MR_INSPECT__" not in text:
+        raise DockerAccessProblem(f"cannot list the containers: {str(stderr).strip()}")
+    ps_block = text[text.index("__MR_PS__") + len("__MR_PS__"):text.index("__MR_INSPECT__")]
+    details = {}
+    for d in parse_docker_inspect(text[text.index("__MR_INSPECT__") + len("__MR_INSPECT__"):]):
+        details[d.get("Id", "")] = d
+    containers = []
+    for line in ps_block.split("\n"):
+        line = line.strip()
+        if not line.startswith("{"):
+            continue
+        ps = json.loads(line)
+        containers.append(ContainerRecord(details.get(ps.get("ID", ""), {}), ps))
+    return containers
+
+
+def parse_docker_inspect(stdout: str) -> list[dict]:
+    """
+    the documents of docker inspect. the ids that are not found are left out by docker,
+    an output that cannot be read gives nothing, e.g. a container removed in the middle of the inspect.
+    """
+    text = str(stdout).replace("\r", "").strip()
+    if not text.startswith("["):
+        return []
+    try:
+        return json.loads(text)
+    except json.JSONDecodeError:
+        return []
+
+
+def docker_inspect(c: Connection, contain_ids: Union[str, list[str]], dump: bool = False) -> list[ContainerRecord]:
+    """
+    inspect all the containers in one call and read the output in memory.
+    with dump or Config.DOCKER_INSPECT_DUMP the raw output is also kept in DATAPATH_BASE/command_prompt_tmp
+    """
+    ids = [contain_ids] if isinstance(contain_ids, str) else list(dict.fromkeys(contain_ids))
+    if len(ids) == 0:
+        return []
+    r = c.run(f"{program_path(c, 'docker')} inspect {' '.join(ids)}", pty=False, timeout=1900, hide=True, warn=True)
+    if dump or Config.DOCKER_INSPECT_DUMP:
+        docker_save_console_result(r)
+    return [ContainerRecord(d) for d in parse_docker_inspect(r.stdout)]
+
+
 def docker_read_console_result():
     io = open(os.path.join(Config.DATAPATH_BASE, 'command_prompt_tmp'), 'r')
     content = io.read()
@@ -340,38 +726,101 @@ def docker_read_console_result():
 
 
 def docker_save_console_result(r):
-    content = r.stdout
-    io = open(os.path.join(Config.DATAPATH_BASE, 'command_prompt_tmp'), 'w')
-    io.write(content)
-    io.close()
+    """
+    the debug copy of the console output, written aside and moved in place so a reader never sees half of it
+    """
+    path = os.path.join(Config.DATAPATH_BASE, 'command_prompt_tmp')
+    part = f"{path}.{os.getpid()}.{threading.get_ident()}"
+    with open(part, 'w') as io:
+        io.write(r.stdout)
+    os.replace(part, path)
 
 
-def docker_inspect_file(c: Connection, container_id: str):
-    command = f'docker inspect {container_id}'
-    r = c.run(command, pty=True, timeout=1900, hide=True, warn=True, echo=False)
-    docker_save_console_result(r)
-    return docker_read_console_result()
-
-
-def docker_restart_containers(c: Connection, contain_ids, result_line=None):
-    if isinstance(contain_ids, list):
-        for id in contain_ids:
-            rv = c.run(
-                f"{Config.DOCKER} restart {id}",
-                pty=True, timeout=1900, warn=True, echo=True
-            )
-            if callable(result_line):
-                line = str(rv.stdout.strip().replace("\n", "")).lower()
-                result_line(line, id)
-
-    if isinstance(contain_ids, str):
-        rv = c.run(
-            f"{Config.DOCKER} restart {contain_ids}",
-            pty=True, timeout=1900, warn=True, echo=True
-        )
-        if callable(result_line):
-            line = str(rv.stdout.strip().replace("\n", "")).lower()
-            result_line(line, contain_ids)
+def docker_inspect_file(c: Connection, container_id: str) -> list[dict]:
+    return [k.inspect for k in docker_inspect(c, container_id)]
+
+
+def docker_batch(c: Connection, command: str, contain_ids: Union[str, list[str]], timeout: int = 1900) -> dict:
+    """
+    run the docker command on all the containers in one round trip. the docker cli stops and removes
+    them in parallel, but restarts them one after another.
+    the result of each container id is (ok, message), the message is the error of docker for that id.
+    """
+    ids = [contain_ids] if isinstance(contain_ids, str) else list(dict.fromkeys(contain_ids))
+    if len(ids) == 0:
+        return {}
+    r = c.run(f"{program_path(c, 'docker')} {command} {' '.join(ids)}", pty=False, timeout=timeout, warn=True, hide=True)
+    results = parse_docker_batch(ids, r.stdout, r.stderr)
+    print_docker_batch(command, results)
+    return results
+
+
+def print_docker_batch(command: str, results: dict):
+    failed = [cid for cid, (ok, _) in results.items() if ok is False]
+    print(f"docker {command}: {len(results) - len(failed)}/{len(results)} containers done")
+    for cid in failed:
+        print(f"  x {cid} {results[cid][1]}")
+
+
+def mentions_container(error: str, cid: str) -> bool:
+    """
+    the id or name as a whole token, so web does not take the error of web-1 and an id prefix
+    does not take the error of a longer id
+    """
+    return re.search(rf"(?<![\w.-]){re.escape(cid)}(?![\w.-])", error) is not None
+
+
+def parse_docker_batch(ids: list[str], stdout: str, stderr: str) -> dict:
+    done = set([line.strip() for line in str(stdout).replace("\r", "").split("\n")])
+    errors = [line.strip() for line in str(stderr).replace("\r", "").split("\n") if line.strip() != ""]
+    general = [e for e in errors if not any([mentions_container(e, cid) for cid in ids])]
+    results = {}
+    for cid in ids:
+        if cid in done:
+            results[cid] = (True, cid)
+            continue
+        found = [e for e in errors if mentions_container(e, cid)]
+        if len(found) > 0:
+            results[cid] = (False, found[0])
+        elif len(general) > 0:
+            # the error of the whole command, e.g. the docker daemon is not running
+            results[cid] = (False, general[-1])
+        else:
+            results[cid] = (False, "no result from docker")
+    return results
+
+
+def docker_restart_containers(c: Connection, contain_ids, result_line=None, wait_seconds: int = -1) -> dict:
+    command = "restart" if wait_seconds < 0 else f"restart -t {wait_seconds}"
+    results = docker_batch(c, command, contain_ids)
+    if callable(result_line):
+        for cid, (ok, message) in results.items():
+            result_line(message.lower(), cid)
+    return results
+
+
+def docker_stop_containers(c: Connection, contain_ids, wait_seconds: int = -1) -> dict:
+    command = "stop" if wait_seconds < 0 else f"stop -t {wait_seconds}"
+    return docker_batch(c, command, contain_ids)
+
+
+def docker_rm_containers(c: Connection, contain_ids, force: bool = False) -> dict:
+    return docker_batch(c, "rm -f" if force else "rm", contain_ids)
+
+
+def docker_stop_rm_containers(c: Connection, contain_ids, timeout: int = 1900) -> dict:
+    """
+    stop and remove the containers in one round trip, the result is the one of the removal
+    """
+    ids = [contain_ids] if isinstance(contain_ids, str) else list(dict.fromkeys(contain_ids))
+    if len(ids) == 0:
+        return {}
+    joined = " ".join(ids)
+    r = c.run(f"{program_path(c, 'docker')} stop {joined} >/dev/null; {program_path(c, 'docker')} rm {joined}",
+              pty=False, timeout=timeout, warn=True, hide=True)
+    results = parse_docker_batch(ids, r.stdout, r.stderr)
+    print_docker_batch("stop + rm", results)
+    return results
 
 
 def docker_launch(c: Connection, vol: Union[str, list[str]], container_name: str, image: str, ver: str, command: str,
@@ -413,7 +862,7 @@ def docker_launch(c: Connection, vol: Union[str, list[str]], container_name: str
         _bindf = " ".join(_sl)
 
     return c.run(DOCKER_LAUNCH_LINE.format(
-        COMMAND_DOCKER=Config.DOCKER,
+        COMMAND_DOCKER=program_path(c, "docker"),
         VOLUME=_vol,
         NETWORK=_net,
         NODE_NAME=container_name,
@@ -427,7 +876,7 @@ def docker_launch(c: Connection, vol: Union[str, list[str]], container_name: str
 
 def stop_container_by_name(c: Connection, container_name: str):
     cmd_line_go = DOCKER_STOP_CONTAIN_NAME.format(
-        COMMAND_DOCKER=Config.DOCKER,
+        COMMAND_DOCKER=program_path(c, "docker"),
         CONTAINER_NAME=container_name
     )
     return c.run(cmd_line_go, pty=True, timeout=1900, warn=True, echo=True)
@@ -440,7 +889,7 @@ def docker_stop_by_prefix(c: Connection, word: str):
 
 def rm_container_by_name(c: Connection, container_name: str):
     cmd_line_go = DOCKER_RM_NAME_BASED.format(
-        COMMAND_DOCKER=Config.DOCKER,
+        COMMAND_DOCKER=program_path(c, "docker"),
         CONTAINER_NAME=container_name
     )
     return c.run(cmd_line_go, pty=True, timeout=1900, warn=True, echo=True)
@@ -448,7 +897,7 @@ def rm_container_by_name(c: Connection, container_name: str):
 
 def rm_vol_by_name(c: Connection, container_name: str):
     cmd_line_go = DOCKER_RM_VOLUME.format(
-        COMMAND_DOCKER=Config.DOCKER,
+        COMMAND_DOCKER=program_path(c, "docker"),
         CONTAINER_NAME=container_name
     )
     return c.run(cmd_line_go, pty=True, timeout=1900, warn=True, echo=True)
@@ -458,14 +907,14 @@ def log_review(c: Connection, container_word: str, log_recent_lines: int):
     """
     show the docker logs
     """
-    pick_logs = DOCKER_LOG_REVIEW.replace("COMMAND_DOCKER", Config.DOCKER)
+    pick_logs = DOCKER_LOG_REVIEW.replace("COMMAND_DOCKER", program_path(c, "docker"))
     pick_logs = pick_logs.replace("__CONTAINER_KEYWORD", container_word)
     pick_logs = pick_logs.replace("__RECENT_LINES", str(log_recent_lines))
     return c.run(pick_logs, pty=True, timeout=1900, warn=True, echo=True)
 
 
 def exec_container_program(c: Connection, container_id: str, bash_line: str) -> Result:
-    cmd2 = f'{Config.DOCKER} exec {container_id} {bash_line} &'
+    cmd2 = f'{program_path(c, "docker")} exec {container_id} {bash_line} &'
     return c.run(cmd2, pty=True, timeout=900, warn=True)
 
 
@@ -475,12 +924,8 @@ def deploy_container_with_docker_compose(
     """
     please check if the docker-compose exists otherwise it will have a problem
     """
-    tmp_file = BufferFile()
-    tmp_file.setName("tmp_docker-compose.yml")
-    tmp_file.add_cmd(docker_compose_file_content)
     remote_path = os.path.join(Config.REMOTE_WS, "docker-compose.yml")
-    local_path = os.path.join(Config.DATAPATH_BASE, tmp_file.execution_cmd)
-    c.put(local_path, remote_path)
+    put_content(c, docker_compose_file_content + "\n", remote_path)
     return exec_docker_compose(c, Config.REMOTE_WS, "docker-compose.yml", force_recreate)
 
 
@@ -595,7 +1040,7 @@ def docker_launch_solution(c: Connection, node_name: str, pass_file: str):
 
 
 def docker_get_network_name_by_container_id(c: Connection, container_id: str) -> str:
-    content = DOCKER_GET_NETWORK_NAME.replace("COMMAND_DOCKER", Config.DOCKER).replace("CONTAINER_ID", container_id)
+    content = DOCKER_GET_NETWORK_NAME.replace("COMMAND_DOCKER", program_path(c, "docker")).replace("CONTAINER_ID", container_id)
     r = c.run(content, timeout=90, warn=True, hide=True)
     if r.ok:
         return str(r.stdout.strip().replace("\n", ""))
@@ -603,7 +1048,7 @@ def docker_get_network_name_by_container_id(c: Connection, container_id: str) ->
 
 
 def docker_get_container_id_by_keyword(c: Connection, keyword: str) -> str:
-    content = DOCKER_GET_CONTAINER_ID.replace("COMMAND_DOCKER", Config.DOCKER).replace("__IMAGE_NAME_OR_KEYWORD__",
+    content = DOCKER_GET_CONTAINER_ID.replace("COMMAND_DOCKER", program_path(c, "docker")).replace("__IMAGE_NAME_OR_KEYWORD__",
                                                                                        keyword)
     r = c.run(content, timeout=90, warn=True, hide=True)
     if r.ok:
@@ -651,21 +1096,145 @@ def install_clash_network(
     exec_shell_program(c, "/tmp", content2)
 
 
+def bastion_connection(bastion: dict) -> Connection:
+    """
+    the connection to the jump host of an ssh tunnel, authenticated once and shared by all the hosts behind it.
+    it is checked out of GATEWAYS, the host connection using it gives it back when the pool closes that host.
+    """
+    def factory() -> Connection:
+        connect_kwargs = {}
+        if bastion["pass"] != "":
+            connect_kwargs["password"] = bastion["pass"]
+        if bastion["key"] != "":
+            connect_kwargs["key_filename"] = [bastion["key"]]
+        c = Connection(host=bastion["host"], port=bastion["port"], user=bastion["user"], connect_kwargs=connect_kwargs)
+        # opened here under the pool lock, so the hosts starting together never race on the handshake
+        c.open()
+        print(f"bastion {bastion_address(bastion)} connected")
+        return c
+
+    return GATEWAYS.acquire(bastion_address(bastion), (bastion["host"], bastion["port"], bastion["user"]), factory)
+
+
+class MeteredConnection(Connection):
+    """
+    a fabric connection that counts the commands it runs and the size of their output
+    """
+    # declared on the class so fabric keeps them as attributes instead of config entries
+    commands: int = 0
+    stdout_bytes: int = 0
+    stderr_bytes: int = 0
+    exit_status: int = 0
+    # the program paths of the host found by apply_host_facts
+    programs: dict = None
+
+    def reset_meter(self):
+        self.commands = 0
+        self.stdout_bytes = 0
+        self.stderr_bytes = 0
+        self.exit_status = 0
+
+    def _meter(self, r: Result):
+        self.commands += 1
+        self.stdout_bytes += len(r.stdout or "")
+        self.stderr_bytes += len(r.stderr or "")
+        if r.exited != 0:
+            self.exit_status = r.exited
+
+    def run(self, command, **kwargs):
+        try:
+            r = super().run(command, **kwargs)
+        except UnexpectedExit as e:
+            self._meter(e.result)
+            raise
+        self._meter(r)
+        return r
+
+    def sudo(self, command, **kwargs):
+        try:
+            r = super().sudo(command, **kwargs)
+        except UnexpectedExit as e:
+            self._meter(e.result)
+            raise
+        self._meter(r)
+        return r
+
+
 class DeploymentBotFoundation:
     # the text file servers that recorded the authentications and some basic information
-    srv: Servers
+    _srv: Servers
     start_server_from: int
     stop_server_at: int
     start_server_in_list: list[int]
+    # the amount of hosts running at the same time
+    concurrency: int
 
     def __init__(self, server_room: str):
         # the server room file, usually "xxxx_server_room.txt", located under cache folder.
-        self.srv = Servers(server_room)
+        self._thread = threading.local()
+        self._srv = Servers(server_room)
         self.start_server_from = 0
         self.stop_server_at = self.srv.serv_count - 1
         self.start_server_in_list = []
+        self.concurrency = Config.FLEET_CONCURRENCY
         self.srv.detect_servers()
 
+    @property
+    def srv(self) -> Servers:
+        """
+        the server list of the host under work, each worker thread sees its own copy
+        """
+        own = getattr(self._thread, "srv", None)
+        return self._srv if own is None else own
+
+    @srv.setter
+    def srv(self, servers: Servers):
+        self._srv = servers
+
+    def fleet_indexes(self) -> list[int]:
+        first = self.start_server_from
+        if self.srv.has_tunnel() and first == 0:
+            # the first line of the room file is the tunnel profile
+            first = 1
+        return [n for n in range(first, self.srv.serv_count)]
+
+    def _run_host(self, index: int, callback_x=None) -> HostResult:
+        result = HostResult(index)
+        srv = self._srv.fork()
+        self._thread.srv = srv
+        c = None
+        try:
+            srv.read_serv_at(index)
+            result.begin(srv.current_id, srv.current_host)
+            self.stage_0()
+            c = self._est_connection()
+            if isinstance(c, MeteredConnection):
+                c.reset_meter()
+            # the status updates of this host are written at once when the host is done
+            with srv.local().batch():
+                self.stage_1(c)
+                value = callback_x(c) if callable(callback_x) else None
+            result.done(value)
+        except Exception as e:
+            self.handle_exceptions(e, False)
+            result.fail(e)
+        finally:
+            if c is not None:
+                result.meter(c)
+                CONNECTIONS.release(c)
+            self._thread.srv = None
+            srv.close()
+        return result
+
+    def run_hosts(self, indexes: list[int], callback_x=None) -> list[HostResult]:
+        """
+        connect to each server by index and run the stages and the callback,
+        the failure of one host is recorded in its result and does not stop the others.
+        """
+        results = run_fleet(indexes, lambda i: self._run_host(i, callback_x), self.concurrency)
+        print_summary(results)
+        return results
+
     def _config(self) -> FabricConfig:
         return FabricConfig({
             'run': {
@@ -678,52 +1247,76 @@ class DeploymentBotFoundation:
     def run_tunnel_detection(self):
         if self.srv.tunnel_type == TunnelType.NO_TUNNEL:
             return False
+        if self.srv.tunnel_type == TunnelType.SSH:
+            # opened once before the hosts start, they all reuse it
+            GATEWAYS.release(bastion_connection(self.srv.bastion))
+            return True
         conn.use_macos_vpn_on(self.srv.profile_name)
         return True
 
     def run_tunnel_detection_off(self):
         if self.srv.tunnel_type == TunnelType.NO_TUNNEL:
             return False
+        if self.srv.tunnel_type == TunnelType.SSH:
+            # the bastion stays in GATEWAYS while any pooled host runs through it, then until it is idle
+            return True
         conn.use_macos_vpn_off(self.srv.profile_name)
         return True
 
+    def _gateway(self) -> Union[Connection, None]:
+        if self.srv.tunnel_type != TunnelType.SSH:
+            return None
+        return bastion_connection(self.srv.bastion)
+
     def _est_connection(self) -> Connection:
+        """
+        the connection of the current server, reused from the pool when it is still alive.
+        it is checked out of the pool until CONNECTIONS.release
+        """
+        signature = (self.srv.current_host, self.srv.current_srv_port, self.srv.current_user)
+        return CONNECTIONS.acquire(self.srv.current_id, signature, self._new_connection)
+
+    def close_connections(self):
+        CONNECTIONS.close_all()
+
+    def _new_connection(self) -> Connection:
         # Get the custom SSH key path if specified
         custom_ssh_key = self.srv.get_cert_path()
         use_ssh_key = custom_ssh_key and custom_ssh_key != os.path.expanduser("~/.ssh/id_rsa")
+        gateway = self._gateway()
         
         if self.srv.has_this_server() is False:
             # New server - use password or custom SSH key if specified
             connect_kwargs = {"password": self.srv.current_pass}
             if use_ssh_key:
                 connect_kwargs["key_filename"] = [custom_ssh_key]
-            return Connection(
+            return MeteredConnection(
                 host=self.srv.current_host,
-                port=22,
+                port=self.srv.current_srv_port,
                 user=self.srv.current_user,
                 connect_kwargs=connect_kwargs,
-                config=self._config())
+                config=self._config(), gateway=gateway)
         elif self.srv.is_cert_installed() is False:
             # Server exists but no cert installed - use password or custom SSH key if specified
             connect_kwargs = {"password": self.srv.current_pass}
             if use_ssh_key:
                 connect_kwargs["key_filename"] = [custom_ssh_key]
-            return Connection(
+            return MeteredConnection(
                 host=self.srv.current_host,
                 port=self.srv.current_srv_port,
                 user=self.srv.current_user,
                 connect_kwargs=connect_kwargs, 
-                config=self._config())
+                config=self._config(), gateway=gateway)
         else:
             # Cert is installed - use SSH key authentication
             print("cert is installed.")
-            return Connection(
+            return MeteredConnection(
                 host=self.srv.current_host,
                 port=self.srv.current_srv_port,
                 user=self.srv.current_user,
                 connect_kwargs={
                     "key_filename": [custom_ssh_key]
-                }, config=self._config())
+                }, config=self._config(), gateway=gateway)
 
     def connection_err(self, item: Exception, on_err_exit: bool):
         print("======================== exit.")
@@ -760,26 +1353,27 @@ class DeploymentBotFoundation:
         for key in Config.STAGE1:
             self._stage_loop(c, key)
 
-    def load_system_paths(self, c: Connection):
-        r = c.run("which bash", warn=True, pty=True)
-        if str(r.stdout.strip()) != "":
-            Config.BASH = str(r.stdout.strip())
-        r = c.run("which docker", warn=True, pty=True)
-        if str(r.stdout.strip()) != "":
-            Config.DOCKER = str(r.stdout.strip())
-            r = c.run(f"{Config.DOCKER} --version", warn=True, pty=True)
-            if docker_version_checker(r):
-                self.srv.local().docker_ce_install()
-            else:
-                r = c.run("which docker-compose", warn=True, pty=True)
-                if str(r.stdout.strip()) != "":
-                    Config.DOCKER_COMPOSE = str(r.stdout.strip())
-                    self.srv.local().docker_compose_install()
-                self.maybe_upgrade_docker()
+    def host_facts(self, c: Connection, refresh: bool = False) -> dict:
+        """
+        the facts of the current host, probed again only when the cached copy is older than Config.FACTS_TTL_SECONDS
+        """
+        facts = {} if refresh else self.srv.local().get_facts(Config.FACTS_TTL_SECONDS)
+        if len(facts) == 0:
+            facts = collect_facts(c)
+            self.srv.local().update_facts(facts)
+        return facts
+
+    def has_program(self, c: Connection, program: str) -> bool:
+        paths = self.host_facts(c).get("paths", {})
+        if program in paths:
+            return paths[program] != ""
+        return detect_program(c, program)
 
-        r = c.run("which daed", warn=True, pty=True)
-        if str(r.stdout.strip()) != "":
-            self.srv.local().dae_install()
+    def load_system_paths(self, c: Connection):
+        if apply_host_facts(c, self.srv.local(), self.host_facts(c)):
+            self.maybe_upgrade_docker()
+            # the upgrade may have changed the docker version and paths
+            apply_host_facts(c, self.srv.local(), self.host_facts(c, refresh=True))
 
     def _stage_loop(self, c: Connection, task: str):
         if task == "cert":
@@ -796,17 +1390,19 @@ class DeploymentBotFoundation:
 
         if task == "python":
             if self.srv.local().is_python_installed() is False:
-                if detect_program(c, "python3") is False:
+                if self.has_program(c, "python3") is False:
                     print("python3 needs to install")
                     install_python(c)
                     self.srv.local().python3_install()
+                    self.srv.local().forget_facts()
 
         if task == "daed":
             if self.srv.local().is_dae_installed() is False:
-                if detect_program(c, "daed") is False:
+                if self.has_program(c, "daed") is False:
                     print("daed will be installed")
                     install_dae_proxy(c)
                     self.srv.local().dae_install()
+                    self.srv.local().forget_facts()
 
         if task == "watchtower":
             if self.srv.local().is_watchtower_installed() is False:
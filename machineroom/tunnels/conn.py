@@ -1,19 +1,21 @@
 #!/usr/bin/env python3
-import json
-import sys
 import os
+import re
+import select
+import subprocess
 import time
 from configparser import ConfigParser
 from machineroom import Config
+from machineroom.errs import MachineRoomErr, TunnelTimeout
+from machineroom.tunnels.state import TUNNELS, CONNECTED, wait_until
 
 
 def sh(script):
     os.system("bash -c '%s'" % script)
 
 
-def run_script(script: str, stdin=None):
+def run_script(script: str, stdin=None, timeout: float = 50):
     """Returns (stdout, stderr), raises error on non-zero return code"""
-    import subprocess
     # Note: by using a list here (['bash', ...]) you avoid quoting issues, as the
     # arguments are passed in exactly this order (spaces, quotes, and newlines won't
     # cause problems):
@@ -21,7 +23,12 @@ def run_script(script: str, stdin=None):
         ['bash', '-c', script], stdout=subprocess.PIPE,
         stderr=subprocess.PIPE, stdin=subprocess.PIPE
     )
-    stdout, stderr = proc.communicate(timeout=50)
+    try:
+        stdout, stderr = proc.communicate(timeout=timeout)
+    except subprocess.TimeoutExpired:
+        proc.kill()
+        proc.communicate()
+        raise
     stdout = stdout.decode('utf-8', 'ignore')
     if proc.returncode:
         raise ScriptException(proc.returncode, stdout, stderr, script)
@@ -33,7 +40,7 @@ class ScriptException(Exception):
         self.returncode = returncode
         self.stdout = stdout
         self.stderr = stderr
-        Exception.__init__('Error in script')
+        Exception.__init__(self, 'Error in script')
 
 
 def disconnect():
@@ -43,7 +50,7 @@ def disconnect():
         time.sleep(0.5)
         print("ipsec down......")
         try:
-            stdout, stderror = run_script(r"ipsec down XXX-YOUR-CONNECTION-NAME-XXX")
+            stdout, stderror = run_script(f"ipsec down {Config.L2TP_CONNECTION_NAME}")
         except:
             pass
     else:
@@ -90,60 +97,21 @@ def checkRunning():
 
 
 def reconnect():
-    success = False
-    i = 0
-    trialTime = 3
-    while success == False and i < trialTime:
-        i = i + 1
-        status = False
-        while status == False:
-            print("starting service...")
-            sh("touch /var/run/xl2tpd/l2tp-control")
-            sh("rm -rf /var/run/xl2tpd/l2tp-control")
-            sh("touch /var/run/xl2tpd/l2tp-control")
-            time.sleep(0.5)
-            sh("service strongswan-starter restart")
-            time.sleep(0.5)
-            sh("service xl2tpd force-reload")
-            time.sleep(0.8)
-            sh("service xl2tpd restart")
-            time.sleep(0.8)
-            status = checkRunning()
-
-        print("ipsec up......")
-        try:
-            stdout, stderror = run_script(r"ipsec down XXX-YOUR-CONNECTION-NAME-XXX")
-        except:
-            pass
-        try:
-            stdout, stderror = run_script(r"ipsec up XXX-YOUR-CONNECTION-NAME-XXX")
-        except:
-            pass
-        if "established successfully" in stdout:
-            # success = True
-            print("ipsec up established successfully")
-            return True
-        else:
-            success = False
-            print("ipsec up failed, try again{}".format(i))
-        if success == False and i >= trialTime:
-            raise Exception("\n\nip address failed, try again")
+    machine = L2tpConnect()
+    machine.services()
+    machine.ipsec()
+    return True
 
 
 def login(user_name, pwd, waitSeconds=5):
-    # need a few seconds to login
-    time.sleep(1)
-    auth = r'echo "c XXX-YOUR-CONNECTION-NAME-XXX {} {}" > /var/run/xl2tpd/l2tp-control '.format(user_name, pwd)
-    sh(auth)
-    # wait for a few seconds to check auth
-    print("waiting {}s for checking in...".format(waitSeconds))
-    time.sleep(waitSeconds)
+    machine = L2tpConnect()
+    machine.user = user_name
+    machine.pwd = pwd
     try:
-        ppp, stderr = run_script(r"ip a | grep ppp")
-        return True
-    except:
-        pass
-    return False
+        machine.login(waitSeconds)
+    except TunnelTimeout:
+        return False
+    return True
 
 
 def getGW():
@@ -159,98 +127,215 @@ def getPTP():
     return stdout
 
 
-def vpn_login_conn():
-    ip, psk, user, pwd = auto_confi()
-    i = 0
-    # 90 <= Total seconds of Wait
-    trialTimes = 6
-    # 90 or 120 recomanded
-    WaitSecondsToRetryDependOnServerResponds = 30
-    while i <= trialTimes:
-        i = i + 1
-        reconnect()  # successfully ipsec up
-        print("try to login with user and password")
-        if login(user_name=user, pwd=pwd, waitSeconds=3):
-            print("ppp established")
-            break
-        if i >= trialTimes:
-            raise Exception(
-                "\n\ncannot login with user name and password. \nunkown error, please try again\nTips: increase login waitSeconds")
-        print(
-            "login did not bring up ppp. \nYour IP may be blocked for a while. Try all over again. Max time:{} Now:{}".format(
-                trialTimes, i))
-        time.sleep(WaitSecondsToRetryDependOnServerResponds)
-
-    print("ppp established, adding route...")
+PPP_LINK = re.compile(r"^\d+:\s+(ppp\d+)[:@]", re.M)
+PPP_PEER = re.compile(r"peer\s+([0-9.]+)")
+
+
+def ppp_interface() -> str:
+    """
+    the name of the first ppp interface, empty when there is none
+    """
     try:
-        std, e = run_script("ifconfig ppp")
-        print(std)
-    except:
-        print("error occur when ifconfig")
-
-    time.sleep(0.5)
-    gateway = getGW()
-
-    # getPTP()
-    i = 0
-    sleepSeconds = 1
-    trialTimes = 30
-    vpnServerLocalIp = False
-    while not vpnServerLocalIp:
-        time.sleep(sleepSeconds)
-        i = i + 1
-        if i >= trialTimes:
-            print("ppp did not bright up after {} seconds, please increase its waiting time".format(trialTimes))
-            sys.exit(1)
+        stdout, stderr = run_script("ip -o link show", timeout=5)
+    except Exception:
+        return ""
+    found = PPP_LINK.findall(stdout)
+    return found[0] if len(found) > 0 else ""
+
+
+def ppp_peer(interface: str) -> str:
+    """
+    the point to point address of the vpn server on the ppp interface, empty until it is assigned
+    """
+    try:
+        stdout, stderr = run_script(f"ip -o addr show dev {interface}", timeout=5)
+    except Exception:
+        return ""
+    found = PPP_PEER.findall(stdout)
+    return found[0] if len(found) > 0 else ""
+
+
+def wait_for_netlink(check, objects: str, timeout: float, what: str) -> float:
+    """
+    call check again on every `ip monitor` event of the objects (link, address, route) until it is true,
+    so the wait ends as soon as the kernel reports the change. polls with backoff when ip monitor is not there.
+    """
+    started = time.monotonic()
+    try:
+        proc = subprocess.Popen(["ip", "-o", "monitor", objects], stdout=subprocess.PIPE,
+                                stderr=subprocess.DEVNULL, text=True)
+    except OSError:
+        return wait_until(check, timeout, what)
+    try:
+        # the monitor runs before the first check, so no event is missed in between
+        deadline = started + timeout
+        while True:
+            if check():
+                return time.monotonic() - started
+            left = deadline - time.monotonic()
+            if left <= 0:
+                raise TunnelTimeout(f"{what} after {timeout}s")
+            ready, _, _ = select.select([proc.stdout], [], [], min(left, Config.TUNNEL_POLL_MAX))
+            if ready and proc.stdout.readline() == "":
+                # the monitor is gone, poll for the rest of the time
+                wait_until(check, max(deadline - time.monotonic(), 0), what)
+                return time.monotonic() - started
+    finally:
+        proc.terminate()
+        proc.wait()
+
+
+class L2tpConnect:
+    """
+    the l2tp/ipsec bring up as a state machine, each phase waits on its own readiness signal
+    until its deadline in Config, and the seconds of each phase are kept in metrics.
+    services -> ipsec -> login -> ptp -> route -> done, a failed ipsec up or a login that does not bring up ppp
+    goes back to services, each a bounded number of times.
+    """
+    ip: str
+    psk: str
+    user: str
+    pwd: str
+    interface: str
+    peer: str
+    attempts: int
+    ipsec_attempts: int
+    metrics: dict
+
+    def __init__(self):
+        self.ip = ""
+        self.psk = ""
+        self.user = ""
+        self.pwd = ""
+        self.interface = ""
+        self.peer = ""
+        self.attempts = 0
+        self.ipsec_attempts = 0
+        self.metrics = {}
+
+    def run(self) -> dict:
+        """
+        connect and return the seconds spent in each phase
+        """
+        state = "configure"
+        while state != "done":
+            started = time.monotonic()
+            next_state = getattr(self, f"_on_{state}")()
+            self.metrics[state] = round(self.metrics.get(state, 0.0) + time.monotonic() - started, 3)
+            state = next_state
+        print("l2tp connected in " + ", ".join([f"{k} {v}s" for (k, v) in self.metrics.items()]))
+        return self.metrics
+
+    def _on_configure(self) -> str:
+        conf = auto_confi()
+        if conf is None:
+            raise MachineRoomErr("the l2tp_client/config.ini is not found")
+        (self.ip, self.psk, self.user, self.pwd) = conf
+        return "services"
+
+    def _on_services(self) -> str:
+        self.services()
+        return "ipsec"
+
+    def _on_ipsec(self) -> str:
         try:
-            vpnServerLocalIp = getPTP()
-        except:
+            self.ipsec()
+            self.ipsec_attempts = 0
+            return "login"
+        except MachineRoomErr as e:
+            # the failures in a row, the ipsec up of each login retry starts them again
+            self.ipsec_attempts += 1
+            if self.ipsec_attempts >= Config.L2TP_IPSEC_ATTEMPTS:
+                raise
+            print(f"{e}, restart the services, {self.ipsec_attempts} of {Config.L2TP_IPSEC_ATTEMPTS}")
+            return "services"
+
+    def _on_login(self) -> str:
+        self.attempts += 1
+        try:
+            self.login(Config.L2TP_PPP_TIMEOUT)
+            return "ptp"
+        except TunnelTimeout:
+            if self.attempts >= Config.L2TP_LOGIN_ATTEMPTS:
+                raise TunnelTimeout(f"cannot login with user name and password after {self.attempts} attempts")
+            print(f"login did not bring up ppp, your IP may be blocked for a while. "
+                  f"try again in {Config.L2TP_RETRY_WAIT}s, {self.attempts} of {Config.L2TP_LOGIN_ATTEMPTS}")
+            # the server refuses the logins in a row, this pause is its cool down and not a readiness wait
+            time.sleep(Config.L2TP_RETRY_WAIT)
+            return "services"
+
+    def _on_ptp(self) -> str:
+        wait_for_netlink(self._has_peer, "address", Config.L2TP_PPP_TIMEOUT, f"no P-t-P address on {self.interface}")
+        print("P-t-P estabished")
+        return "route"
+
+    def _on_route(self) -> str:
+        gateway = getGW().strip().split("\n")[0]
+        sh("route add {} gw {}".format(self.ip, gateway))
+        print(r"route add -net 10.0.0.0/8  gw {}".format(self.peer))
+        sh("route add -net 10.0.0.0/8  gw {}".format(self.peer))
+        return "done"
+
+    def services(self):
+        """
+        restart strongswan and xl2tpd, done when both report running
+        """
+        print("starting service...")
+        sh("mkdir -p /var/run/xl2tpd && rm -f /var/run/xl2tpd/l2tp-control && touch /var/run/xl2tpd/l2tp-control")
+        sh("service strongswan-starter restart")
+        sh("service xl2tpd restart")
+        wait_until(checkRunning, Config.L2TP_SERVICE_TIMEOUT, "strongswan and xl2tpd are not running")
+
+    def ipsec(self):
+        """
+        `ipsec up` returns once the security association is established or has failed
+        """
+        print("ipsec up......")
+        name = Config.L2TP_CONNECTION_NAME
+        try:
+            run_script(f"ipsec down {name}", timeout=Config.L2TP_IPSEC_TIMEOUT)
+        except Exception:
             pass
-    print("P-t-P estabished")
-    sh("route add {} gw {}".format(ip, gateway))
-    # print(r"route add -net default gw {}".format(vpnServerLocalIp))
-    print(r"route add -net 10.0.0.0/8  gw {}".format(vpnServerLocalIp))
-    # sh("route add -net default gw {}".format(vpnServerLocalIp))
-    sh("route add -net 10.0.0.0/8  gw {}".format(vpnServerLocalIp))
-    print("l2tp connected")
-    print("finished")
-
-
-
-def use_vpn_util_status_on(profile_name: str):
-    o, i = run_script(f"vpnutil status {profile_name}")
-    while True:
-        if len(o) > 0:
-            line = str(o).lower()
-            if "connected" in line:
-                return True
-            else:
-                return False
-
-
-def use_macos_vpn_on(profile_name: str):
-    o, i = run_script("vpnutil list")
-    y = json.loads(o)
-    for h in y['VPNs']:
-        if h['name'] == profile_name:
-            if h['status'] == 'Disconnected':
-                run_script(f"vpnutil start {profile_name}")
-                print(f"connect {profile_name} in progress")
-                while True:
-                    if use_vpn_util_status_on(profile_name):
-                        print("connected")
-                        return True
-
-
-def use_macos_vpn_off(profile_name: str):
-    o, i = run_script("vpnutil list")
-    y = json.loads(o)
-    for h in y['VPNs']:
-        if h['name'] == profile_name:
-            if h['status'] == 'Connected':
-                run_script(f"vpnutil stop {profile_name}")
-                print(f"connect {profile_name} in progress")
-                while True:
-                    if not use_vpn_util_status_on(profile_name):
-                        print("disconnected")
-                        return True
\ No newline at end of file
+        try:
+            stdout, stderr = run_script(f"ipsec up {name}", timeout=Config.L2TP_IPSEC_TIMEOUT)
+        except ScriptException as e:
+            stdout = e.stdout
+        except subprocess.TimeoutExpired:
+            raise TunnelTimeout(f"ipsec up {name} did not finish after {Config.L2TP_IPSEC_TIMEOUT}s")
+        if "established successfully" not in stdout:
+            raise MachineRoomErr(f"ipsec up {name} failed: {stdout.strip()}")
+        print("ipsec up established successfully")
+
+    def login(self, timeout: float):
+        """
+        ask xl2tpd to dial in, done when the ppp interface shows up
+        """
+        print("try to login with user and password")
+        auth = r'echo "c {} {} {}" > /var/run/xl2tpd/l2tp-control '.format(Config.L2TP_CONNECTION_NAME, self.user, self.pwd)
+        sh(auth)
+        wait_for_netlink(self._has_interface, "link", timeout, "login did not bring up ppp")
+        print(f"ppp established on {self.interface}")
+
+    def _has_interface(self) -> bool:
+        self.interface = ppp_interface()
+        return self.interface != ""
+
+    def _has_peer(self) -> bool:
+        self.peer = ppp_peer(self.interface)
+        return self.peer != ""
+
+
+def vpn_login_conn():
+    return L2tpConnect().run()
+
+
+def use_vpn_util_status_on(profile_name: str) -> bool:
+    return TUNNELS.status(profile_name, fresh=True) == CONNECTED
+
+
+def use_macos_vpn_on(profile_name: str) -> bool:
+    return TUNNELS.up(profile_name)
+
+
+def use_macos_vpn_off(profile_name: str) -> bool:
+    return TUNNELS.down(profile_name)
@@ -0,0 +1,185 @@
+"""
+the state of the vpn profiles of this machine.
+the status is polled with a growing wait until a deadline instead of a busy loop,
+and kept for a few seconds so the room files sharing a profile do not ask again.
+"""
+import json
+import subprocess
+import threading
+import time
+from contextlib import contextmanager
+from typing import Callable
+
+from machineroom.const import Config
+from machineroom.errs import TunnelTimeout, MachineRoomErr
+
+CONNECTED = "connected"
+DISCONNECTED = "disconnected"
+UNKNOWN = "unknown"
+
+
+def normalize_status(status: str) -> str:
+    line = str(status).strip().lower()
+    # disconnected contains connected, so it is checked first
+    if line.startswith("disconnected"):
+        return DISCONNECTED
+    if line.startswith("connected"):
+        return CONNECTED
+    return line if line != "" else UNKNOWN
+
+
+def wait_until(check: Callable[[], bool], timeout: float, what: str) -> float:
+    """
+    call check until it is true, the wait doubles each round from Config.TUNNEL_POLL_FIRST up to Config.TUNNEL_POLL_MAX.
+    returns the seconds it took and raises TunnelTimeout at the deadline.
+    """
+    started = time.monotonic()
+    deadline = started + timeout
+    delay = Config.TUNNEL_POLL_FIRST
+    while True:
+        if check():
+            return time.monotonic() - started
+        left = deadline - time.monotonic()
+        if left <= 0:
+            raise TunnelTimeout(f"{what} after {timeout}s")
+        time.sleep(min(delay, left))
+        delay = min(delay * 2, Config.TUNNEL_POLL_MAX)
+
+
+class StatusProvider:
+    """
+    the vpnutil command line of macos, any script answering `list`, `start <name>` and `stop <name>`
+    the same way can stand in for it, see Config.VPNUTIL
+    """
+    command: str
+
+    def __init__(self, command: str = ""):
+        self.command = command
+
+    def _run(self, *args) -> str:
+        command = self.command if self.command != "" else Config.VPNUTIL
+        r = subprocess.run([command, *args], capture_output=True, text=True, timeout=Config.TUNNEL_COMMAND_TIMEOUT)
+        if r.returncode != 0:
+            raise MachineRoomErr(f"{command} {' '.join(args)} failed: {r.stderr.strip()}")
+        return r.stdout
+
+    def list(self) -> dict:
+        """
+        the status of every vpn profile by its name
+        """
+        y = json.loads(self._run("list"))
+        return {h["name"]: normalize_status(h.get("status", "")) for h in y.get("VPNs", [])}
+
+    def start(self, profile_name: str):
+        self._run("start", profile_name)
+
+    def stop(self, profile_name: str):
+        self._run("stop", profile_name)
+
+
+class TunnelWatcher:
+    """
+    bring the vpn profiles up and down and wait for them with a bounded exponential backoff
+    """
+    provider: StatusProvider
+
+    def __init__(self, provider: StatusProvider = None):
+        self.provider = provider if provider is not None else StatusProvider()
+        self._cache = {}
+        self._checked_at = 0.0
+        self._lock = threading.RLock()
+        # the profiles held up by a scheduler, their count of holders
+        self._holds = {}
+        # how many status queries were sent to the provider
+        self.queries = 0
+
+    def use(self, provider: StatusProvider):
+        with self._lock:
+            self.provider = provider
+            self.forget()
+
+    def forget(self):
+        self._cache = {}
+        self._checked_at = 0.0
+
+    def refresh(self) -> dict:
+        with self._lock:
+            self._cache = self.provider.list()
+            self._checked_at = time.monotonic()
+            self.queries += 1
+            return self._cache
+
+    def status(self, profile_name: str, fresh: bool = False) -> str:
+        """
+        the status of the profile, from the cache when it is younger than the ttl
+        """
+        with self._lock:
+            if fresh or time.monotonic() - self._checked_at > Config.TUNNEL_STATUS_TTL:
+                self.refresh()
+            return self._cache.get(profile_name, UNKNOWN)
+
+    def wait_for(self, profile_name: str, want: str, timeout: float) -> str:
+        """
+        poll until the profile has the wanted status, the wait doubles each round up to Config.TUNNEL_POLL_MAX
+        """
+        try:
+            wait_until(lambda: self.status(profile_name, fresh=True) == want, timeout, f"{profile_name} is not {want}")
+        except TunnelTimeout:
+            status = self._cache.get(profile_name, UNKNOWN)
+            raise TunnelTimeout(f"{profile_name} is still {status} after {timeout}s, waiting for {want}")
+        return want
+
+    def up(self, profile_name: str, timeout: float = None) -> bool:
+        """
+        connect the profile and wait for it, False when it was connected already or is unknown
+        """
+        with self._lock:
+            if self._holds.get(profile_name, 0) > 0:
+                return False
+            status = self.status(profile_name)
+            if status == CONNECTED:
+                return False
+            if status == UNKNOWN:
+                print(f"there is no vpn profile {profile_name}")
+                return False
+            self.provider.start(profile_name)
+            print(f"connect {profile_name} in progress")
+            self.wait_for(profile_name, CONNECTED, timeout if timeout is not None else Config.TUNNEL_UP_TIMEOUT)
+            print("connected")
+            return True
+
+    def down(self, profile_name: str, timeout: float = None) -> bool:
+        """
+        disconnect the profile and wait for it, False when it was not connected or is still held
+        """
+        with self._lock:
+            if self._holds.get(profile_name, 0) > 0:
+                return False
+            if self.status(profile_name) != CONNECTED:
+                return False
+            self.provider.stop(profile_name)
+            print(f"disconnect {profile_name} in progress")
+            self.wait_for(profile_name, DISCONNECTED, timeout if timeout is not None else Config.TUNNEL_DOWN_TIMEOUT)
+            print("disconnected")
+            return True
+
+    @contextmanager
+    def hold(self, profile_name: str, timeout: float = None):
+        """
+        keep the profile up for the whole block, the up and down calls of the jobs inside do nothing
+        and the profile goes down when the last holder leaves
+        """
+        with self._lock:
+            self.up(profile_name, timeout)
+            self._holds[profile_name] = self._holds.get(profile_name, 0) + 1
+        try:
+            yield
+        finally:
+            with self._lock:
+                self._holds[profile_name] -= 1
+                if self._holds[profile_name] == 0:
+                    del self._holds[profile_name]
+                    self.down(profile_name)
+
+
+TUNNELS = TunnelWatcher()
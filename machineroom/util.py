@@ -1,19 +1,22 @@
 # !/usr/bin/env python
 # coding: utf-8
+import hashlib
 import re
 import sys
-from fabric import Connection
+import threading
 from subprocess import Popen, PIPE
 import json
 import os.path
-from typing import Union, Tuple, TextIO
+from typing import Union, Tuple, TextIO, TYPE_CHECKING
 
-from invoke import StreamWatcher
 from machineroom.sql import ServerRoom
 
 from .const import *
 from .errs import *
 
+if TYPE_CHECKING:
+    from fabric import Connection
+
 
 def function_command_alias(input: str, actual: str, command_alias: list):
     if input in command_alias:
@@ -21,9 +24,47 @@ def function_command_alias(input: str, actual: str, command_alias: list):
     return False, None
 
 
+# the console sub commands, the handler of each canonical name and the canonical name of each alias
+COMMANDS: dict = {}
+COMMAND_ALIASES: dict[str, str] = {}
+# the words that cannot be a server id because they are console commands
+RESERVED_IDS: frozenset = frozenset()
+
+
+def register_alias(actual: str, command_alias: list = None):
+    global RESERVED_IDS
+    for name in [actual] + list(command_alias or []):
+        COMMAND_ALIASES[name] = actual
+    RESERVED_IDS = frozenset(COMMAND_ALIASES)
+
+
+def register_command(actual: str, command_alias: list = None):
+    """
+    decorator to add the console sub command, the handler takes (local: ServerRoom, opt2, opt3)
+    """
+
+    def wrap(handler):
+        register_alias(actual, command_alias)
+        COMMANDS[actual] = handler
+        return handler
+
+    return wrap
+
+
+register_alias("ls", CMD_LIST)
+register_alias("docker-scan", CMD_SCAN_DOCKER)
+register_alias("scanports", CMD_SCAN_PORT)
+register_alias("import", CMD_IMPORT)
+register_alias("v", CMD_VERSION)
+register_alias("retire", CMD_RETIRE)
+register_alias("off-cert", CMD_OFF_CERT)
+register_alias("add-cert", CMD_ADD_CERT)
+register_alias("watch-profile", CMD_GENERATE_PROFILE)
+register_alias("set-home", CMD_SET_BASH_START)
+
+
 def check_for_bad_ids(id_name: str):
-    all_bad = CMD_SCAN_DOCKER + CMD_IMPORT + CMD_SCAN_PORT + CMD_LIST + CMD_VERSION + CMD_RETIRE + CMD_OFF_CERT + CMD_ADD_CERT + CMD_GENERATE_PROFILE +CMD_SET_BASH_START
-    if id_name in all_bad:
+    if id_name in RESERVED_IDS:
         raise BadIDs()
 
 
@@ -31,7 +72,6 @@ def use_args() -> Tuple[str, str, str]:
     opt1 = ""
     opt2 = ""
     opt3 = ""
-    cmd = "ls"
 
     if len(sys.argv) >= 2:
         opt1 = sys.argv[1]
@@ -40,35 +80,7 @@ def use_args() -> Tuple[str, str, str]:
             if len(sys.argv) >= 4:
                 opt3 = sys.argv[3]
 
-    cmd = opt1
-    f, c = function_command_alias(opt1, "ls", CMD_LIST)
-    if f is True:
-        cmd = c
-    f, c = function_command_alias(opt1, "docker-scan", CMD_SCAN_DOCKER)
-    if f is True:
-        cmd = c
-    f, c = function_command_alias(opt1, "import", CMD_IMPORT)
-    if f is True:
-        cmd = c
-    f, c = function_command_alias(opt1, "v", CMD_VERSION)
-    if f is True:
-        cmd = c
-    f, c = function_command_alias(opt1, "retire", CMD_RETIRE)
-    if f is True:
-        cmd = c
-    f, c = function_command_alias(opt1, "off-cert", CMD_OFF_CERT)
-    if f is True:
-        cmd = c
-    f, c = function_command_alias(opt1, "add-cert", CMD_ADD_CERT)
-    if f is True:
-        cmd = c
-    f, c = function_command_alias(opt1, "watch-profile", CMD_GENERATE_PROFILE)
-    if f is True:
-        cmd = c
-    f, c = function_command_alias(opt1, "set-home", CMD_SET_BASH_START)
-    if f is True:
-        cmd = c
-
+    cmd = COMMAND_ALIASES.get(opt1, opt1)
     return cmd, opt2, opt3
 
 
@@ -422,6 +434,103 @@ class BufferFile:
         print("save as done.")
 
 
+class RoomFile:
+    """
+    the server room file parsed once into an indexed table of records,
+    the table is parsed again only when the file on disk has changed.
+    """
+    path: str
+    _stamp: tuple
+    _records: list
+    _hashes: list
+    _by_id: dict
+
+    def __init__(self, path: str):
+        self.path = path
+        self._stamp = ()
+        self._records = []
+        self._hashes = []
+        self._by_id = {}
+        self.refresh()
+
+    def refresh(self) -> bool:
+        st = os.stat(self.path)
+        stamp = (st.st_mtime_ns, st.st_size)
+        if stamp == self._stamp:
+            return False
+        records = []
+        hashes = []
+        by_id = {}
+        header = ""
+        with open(self.path, 'r') as fp:
+            for content in fp:
+                content = content.strip()
+                if content == "":
+                    continue
+                try:
+                    fields = reader_split_recognition(content)
+                    profile = reader_profile_0(fields)
+                    if len(records) == 0 and "#" in profile.get("id"):
+                        header = content
+                    by_id.setdefault(profile.get("id"), len(records))
+                    records.append((fields, profile))
+                    hashes.append(record_hash(profile, header))
+                except Exception as e:
+                    records.append((None, ServerAuthInfoErr(f"line {len(records)}: {content} ({e})")))
+                    hashes.append("")
+        self._records = records
+        self._hashes = hashes
+        self._by_id = by_id
+        self._stamp = stamp
+        return True
+
+    def __len__(self) -> int:
+        return len(self._records)
+
+    def __iter__(self):
+        for fields, profile in self._records:
+            if fields is not None:
+                yield profile
+
+    def record_at(self, index: int) -> Tuple[list, dict]:
+        (fields, profile) = self._records[index]
+        if fields is None:
+            raise profile
+        return fields, profile
+
+    def index_of(self, server_id: str) -> int:
+        return self._by_id.get(server_id, -1)
+
+    def hash_at(self, index: int) -> str:
+        """
+        the hash of the record with the tunnel header above it, empty for the line that cannot be read
+        """
+        return self._hashes[index]
+
+
+def record_hash(profile: dict, header: str = "") -> str:
+    content = json.dumps({"profile": profile, "tunnel": header}, sort_keys=True)
+    return hashlib.sha1(content.encode("utf-8")).hexdigest()
+
+
+_room_files: dict = {}
+_room_files_lock = threading.Lock()
+
+
+def load_room_file(full_path: str) -> RoomFile:
+    """
+    the shared parsed room file for this path, reloaded when its mtime changes
+    """
+    with _room_files_lock:
+        room = _room_files.get(full_path)
+        if room is None:
+            room = RoomFile(full_path)
+            _room_files[full_path] = room
+        else:
+            room.refresh()
+        return room
+
+
 class Servers:
     _meta_file: str
     current_id: str
@@ -433,17 +542,22 @@ class Servers:
     _meta_file: int
     _tunnel_type: TunnelType
     profile_name: str
+    # the jump host of an ssh tunnel header, empty for the other tunnels
+    bastion: dict
     _on_detect: bool
     _local_db: ServerRoom
+    _owns_db: bool
 
-    def __init__(self, file: str):
+    def __init__(self, file: str, local_db: ServerRoom = None):
         self._meta_file = file
         self.serv_count = 20
         self._tunnel_type = TunnelType.NO_TUNNEL
         self.profile_name = ""
+        self.bastion = {}
         self._srv_index = 0
         self._on_detect = True
-        self._local_db = ServerRoom()
+        self._owns_db = local_db is None
+        self._local_db = ServerRoom() if local_db is None else local_db
 
     @property
     def path_file(self) -> str:
@@ -461,6 +575,23 @@ class Servers:
     def local(self):
         return self._local_db
 
+    def fork(self, share_db: bool = False) -> "Servers":
+        """
+        a copy of this server list with its own db connection, used by one worker thread.
+        with share_db the copy keeps its own server id but reuses this db connection, for tasks in the same thread.
+        """
+        twin = Servers(self._meta_file, self._local_db.view() if share_db else None)
+        twin.serv_count = self.serv_count
+        twin._tunnel_type = self._tunnel_type
+        twin.profile_name = self.profile_name
+        twin.bastion = self.bastion
+        twin._on_detect = False
+        return twin
+
+    def close(self):
+        if self._owns_db:
+            self._local_db.conn.close()
+
     def get_cert_path(self) -> str:
         """
         Get the certificate path for the current server.
@@ -489,8 +620,14 @@ class Servers:
     def tunnel_type(self) -> TunnelType:
         return self._tunnel_type
 
+    @property
+    def room(self) -> RoomFile:
+        return load_room_file(self.path_file)
+
     def detect_servers(self):
-        self.serv_count = read_file_total_lines(self.path_file)
+        self.serv_count = len(self.room)
+        print(f"count lines from {self.path_file}")
+        print('Total Lines', self.serv_count)
         try:
             self.read_serv_at(0)
             self._on_detect = False
@@ -499,9 +636,7 @@ class Servers:
 
     def read_serv_at(self, index: int):
         n = index % self.serv_count
-        line = read_file_at_line(self.path_file, n)
-        line = reader_split_recognition(line)
-        configuration = reader_profile_0(line)
+        (line, configuration) = self.room.record_at(n)
         self._srv_index = n
         ID = configuration.get("id")
         check_for_bad_ids(ID)
@@ -511,6 +646,8 @@ class Servers:
             print(f"Detected tunnel for machine group {ID} using {TUNNEL_TYPE}")
             self._tunnel_type = TunnelType.Recongize(TUNNEL_TYPE)
             self.profile_name = line[0].replace("#", "")
+            if self._tunnel_type == TunnelType.SSH:
+                self.bastion = bastion_of(line)
             raise FoundVPNTunnel()
 
         self.current_id = ID
@@ -535,12 +672,46 @@ class Servers:
             self._local_db.entrance_L2(self.profile_name, auth_data)
         else:
             self._local_db.entrance_L1(auth_data)
+        if len(self.bastion) > 0 and self._local_db.get_res_kv("bastion") != bastion_address(self.bastion):
+            # kept for the interactive ssh -J jump
+            self._local_db.update_res_kv("bastion", bastion_address(self.bastion))
 
         # Handle SSH key path if specified (store in res JSON after row exists)
         ssh_key_path = configuration.get("ssh_key_path")
         if ssh_key_path:
             self._local_db.set_local_cert_path(ssh_key_path)
 
+    def read_serv_by_id(self, server_id: str):
+        n = self.room.index_of(server_id)
+        if n < 0:
+            raise ServerAuthInfoErr(f"there is no such server {server_id} in {self._meta_file}")
+        self.read_serv_at(n)
+
+    def room_hash(self) -> str:
+        """
+        the room file hash of the current server, kept in res once the server is imported
+        """
+        return self.room.hash_at(self._srv_index)
+
+    def mark_imported(self):
+        self._local_db.update_res_kv("room_hash", self.room_hash())
+
+    def changed_indexes(self, indexes: list[int]) -> list[int]:
+        """
+        the indexes of the servers that are new or changed in the room file since their last import
+        """
+        stored = self._local_db.room_hashes()
+        changed = []
+        for n in indexes:
+            digest = self.room.hash_at(n)
+            if digest == "":
+                changed.append(n)
+                continue
+            (_, profile) = self.room.record_at(n)
+            if stored.get(profile.get("id")) != digest:
+                changed.append(n)
+        return changed
+
     def has_tunnel(self) -> bool:
         return self._tunnel_type != TunnelType.NO_TUNNEL
 
@@ -549,6 +720,23 @@ class Servers:
         self.read_serv_at(self._srv_index)
 
 
+def bastion_of(fields: list) -> dict:
+    """
+    the jump host of the ssh tunnel header #profile---ssh---host---user---password---port---key,
+    the user is root, the port is 22 and the password and key are empty when they are left out
+    """
+    def at(n: int, default: str = "") -> str:
+        return fields[n].strip() if len(fields) > n and fields[n].strip() != "" else default
+
+    if at(2) == "":
+        raise ServerAuthInfoErr(f"the ssh tunnel {fields[0]} needs the bastion host")
+    return {"host": at(2), "user": at(3, "root"), "pass": at(4), "port": int(at(5, "22")), "key": at(6)}
+
+
+def bastion_address(bastion: dict) -> str:
+    return f"{bastion['user']}@{bastion['host']}:{bastion['port']}"
+
+
 def reader_split_recognition(line: str) -> list:
     # Handle consecutive delimiters by normalizing them first
     # Replace consecutive delimiters with single delimiter + empty field
@@ -633,7 +821,7 @@ class InfrastructurePlannerFoundation:
     iterate_steps: int
     # the remote workspace
     LOCAL_WORKSPACE: str
-    connector: Connection
+    connector: "Connection"
     tmp_text_io: TextIO
     tmp_file_man: BufferFile
 
@@ -643,12 +831,6 @@ class InfrastructurePlannerFoundation:
         return self
 
 
-class DummyWatcher(StreamWatcher):
-    def submit(self, stream):
-        # print(f'Output: "{stream}"')
-        return []
-
-
 class FieldConstruct:
     def __init__(self):
         self._line_ = ""
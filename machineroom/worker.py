@@ -1,77 +1,33 @@
+import datetime
+import importlib
 import os
-import random
 
-from machineroom import taskbase as tb, __version__, ServerRoom, use_args, FieldConstruct, err_exit
-from machineroom.infra import Infra1
+from machineroom import __version__, ServerRoom, use_args, FieldConstruct, err_exit
+from machineroom.const import *
+from machineroom.util import COMMANDS, register_command
+from machineroom.fleet import FleetReport
+from machineroom.sql import STATUS_FLAGS
 from machineroom.tunnels.conn import *
-from fabric import Connection
-from tabulate import tabulate
-
-try:
-    import SQLiteAsJSON
-except:
-    os.system('python3.11 -m pip install SQLiteAsJSON')
-    import SQLiteAsJSON
 
 execute_path = os.path.dirname(__file__)
 
 
-class ServerDoorJob(Infra1):
-
-    def action_import(self):
-        self.run_conn()
-
-    def action_retire(self):
-        self.run_offline(self._retire_on_each_server)
-
-    def action_off_cert(self):
-        self.run_offline(self._action_off_cert)
-
-    def _retire_on_each_server(self):
-        self.srv.local().update_res_kv("retired", True)
-
-    def _action_off_cert(self):
-        self.srv.local().delete_res_kv("identity_cert_installed")
-
-    def action_scan_ports(self):
-        self.run_conn(self._from_c_ports)
-
-    def _from_c_ports(self, c: Connection):
-        m = tb.list_all_open_ports(c)
-        self.srv.local().update_res_kv("ports", m)
-        any_one = random.choice(m)
-
-    def action_add_custom_cert(self, name, pubkey_path):
-        """Add a custom certificate to servers and store the path."""
-        def certification(c: Connection):
-            if tb.detect_cert_signature(c, name) is False:
-                tb.copy_id(c, pubkey_path)
-                # Store custom cert metadata
-                self.srv.local().update_res_kv(f"custom_cert_{name}", True)
-                # Store the private key path (convert .pub to private key)
-                private_key_path = self._resolve_private_key_path(pubkey_path)
-                self.srv.local().set_local_cert_path(private_key_path)
-        
-        self.run_conn(certification)
+def __getattr__(name: str):
+    # the fleet jobs pull in fabric, they load on first use so the local commands start fast
+    if name in ("ServerDoorJob", "AsyncServerDoorJob", "door_job"):
+        from machineroom import jobs
+        return getattr(jobs, name)
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
 
-    def _resolve_private_key_path(self, pubkey_path: str) -> str:
-        """
-        Convert public key path to private key path.
-        
-        Args:
-            pubkey_path: Path to public key (.pub file)
-        
-        Returns:
-            str: Path to corresponding private key
-        """
-        return pubkey_path.replace(".pub", "")
 
-    def action_remove_custom_cert(self, name):
-        def certification(c: Connection):
-            if tb.detect_cert_signature(c, name) is False:
-                self.srv.local().delete_res_kv(f"custom_cert_{name}")
-
-        self.run_conn(certification)
+def finish_report(report: FleetReport):
+    """
+    print the throughput of the fleet action and keep the report when Config.FLEET_REPORT_DIR is set
+    """
+    report.print_stats()
+    if Config.FLEET_REPORT_DIR != "":
+        os.makedirs(Config.FLEET_REPORT_DIR, exist_ok=True)
+        print(f"report saved to {report.save(Config.FLEET_REPORT_DIR)}")
 
 
 def internal_work():
@@ -93,131 +49,241 @@ def internal_work():
             y.add_icon("PY" if local.is_what_installed_full("python3_installed", id) else "")
 
     """
+    for plugin in Config.COMMAND_PLUGINS:
+        importlib.import_module(plugin)
     (a, b, c) = use_args()
+    if a == "":
+        err_exit("cannot serv no args")
     local = ServerRoom()
-    if a == "ls":
-        gh = local.show_all_serv()
-        table_content = []
-        for (id, host, res) in gh:
-            local.set_server_id(id)
-            content = []
-            content.append(id)
-            content.append(host)
-            tun = local.get_tunnel_profile()
-            if tun != "":
-                content.append(f"TUNNEL PROFILE: {tun}")
-
-            content.append("EXPIRED" if local.is_what_installed_full("retire", id) else "")
-            # CERT column displays whether default cert or custom cert is used when installed
-            if local.is_what_installed_full("identity_cert_installed", id):
-                cert_info = local.get_cert_info()
-                if cert_info.get("is_default"):
-                    content.append("CERT: default")
-                else:
-                    content.append(f"CERT: custom ({cert_info.get('path', '')})")
-            else:
-                content.append("")
-            content.append("DOCKER" if local.is_what_installed_full("docker_compose_installed", id) else "")
-            content.append("DAED" if local.is_what_installed_full("daed_installed", id) else "")
-            content.append("YACHT" if local.is_what_installed_full("yacht_installed", id) else "")
-            content.append("PY" if local.is_what_installed_full("python3_installed", id) else "")
-
-            table_content.append(content)
-
-        print(tabulate(table_content))
-    elif a == "docker-scan":
-        print("This to scan out the running docker containers in the status of that server")
-    elif a == "scanports":
-        print("This to scan out the running docker containers in the status of that server")
-    elif a == "import":
-        if b == "":
-            err_exit("need to have one more arg")
-        file = os.path.join(Config.DATAPATH_BASE, b)
-        if os.path.exists(file) is False:
-            err_exit("Wrong path cannot open this file" + file)
-        job = ServerDoorJob(b)
-        job.action_import()
-    elif a == "v":
-        print(f"version. {__version__}")
-
-    elif a == "watch-profile":
-        if b == "":
-            err_exit("need to have one more arg")
-        file = os.path.join(Config.DATAPATH_BASE, b)
-        if os.path.exists(file) is False:
-            err_exit("Wrong path cannot open this file" + file)
-        job = ServerDoorJob(b)
-        job.action_scan_ports()
-
-    elif a == "set-home":
-        if b == "":
-            err_exit("need to have one more arg for the server ID")
-        if c == "":
-            err_exit("need to have one more arg for the the remote start path, for example /home")
-        local.set_server_id(b)
-        if local.has_this_server() is False:
-            err_exit(f"there is no such server for ---> {b}")
-            local.update_res_kv("home_path", c)
-
-    elif a == "retire":
-        if b == "":
-            err_exit("need to have one more arg")
-        file = os.path.join(Config.DATAPATH_BASE, b)
-        if os.path.exists(file) is False:
-            err_exit("Wrong path cannot open this file" + file)
-        job = ServerDoorJob(b)
-        job.action_retire()
-    elif a == "off-cert":
-        if b == "":
-            err_exit("need to have one more arg")
-        file = os.path.join(Config.DATAPATH_BASE, b)
-        if os.path.exists(file) is False:
-            err_exit("Wrong path cannot open this file" + file)
-        job = ServerDoorJob(b)
-        job.action_off_cert()
-    elif a == "add-cert":
-        print("You are about to adding custom certificate to all servers on behalf this machine room.")
-        if b == "":
-            err_exit("need to have one more arg")
-        file = os.path.join(Config.DATAPATH_BASE, b)
-        if os.path.exists(file) is False:
-            err_exit("Wrong path cannot open this file" + file)
-        job = ServerDoorJob(b)
-        key_path = input(
-            "Enter the path of the pub file. For example /Users/{user_name_here}/.ssh/{user_custom_public_key}.pub")
-        cert_name = input(
-            "Enter the name of the pub file. open the .pub file and usually its located at the very last word of the key file.")
-
-        job.action_add_custom_cert(cert_name, key_path)
-    elif a == "remove-custom-cert":
-        if b == "":
-            err_exit("need to have one more arg")
-        file = os.path.join(Config.DATAPATH_BASE, b)
-        if os.path.exists(file) is False:
-            err_exit("Wrong path cannot open this file" + file)
-        job = ServerDoorJob(b)
-        cert_name = input(
-            "Enter the name of the pub file. open the .pub file and usually its located at the very last word of the key file.")
-        job.action_remove_custom_cert(cert_name)
-    elif a != None:
-        local.set_server_id(a)
-        if local.has_this_server() is False:
-            err_exit(f"there is no such server for ---> {a}")
-        cert_info = local.get_cert_info()
-        cert = cert_info['path'] if cert_info['installed'] else ""
-        (h, u, p) = local.get_info()
-        port_sentence = "" if p == 22 else f"-p {p} "
-        home_path = local.get_res_kv("home_path")
-        home_path = f'"cd {home_path}; bash"' if home_path != "" else ""
-        if local.get_tunnel_profile() != "":
-            print("TUNNEL PROFILE: {local.get_tunnel_profile()}")
-            use_macos_vpn_on(local.get_tunnel_profile())
-        
-        # Use custom SSH key if available, otherwise use default behavior
-        ssh_key_option = f"-i {cert}" if cert else ""
-        os.system(f'ssh {port_sentence}{ssh_key_option} -t {u}@{h} {home_path}')
+    handler = COMMANDS.get(a)
+    if handler is None:
+        jump_to_server(local, a)
     else:
-        err_exit("cannot serv no args")
+        handler(local, b, c)
+
+
+def room_file_arg(b: str) -> str:
+    if b == "":
+        err_exit("need to have one more arg")
+    file = os.path.join(Config.DATAPATH_BASE, b)
+    if os.path.exists(file) is False:
+        err_exit("Wrong path cannot open this file" + file)
+    return b
+
+
+def room_files_arg(b: str) -> list[str]:
+    """
+    the room files of a comma separated list, such as a_server_room.txt,b_server_room.txt
+    """
+    rooms = [k.strip() for k in b.split(",") if k.strip() != ""]
+    if len(rooms) == 0:
+        err_exit("need to have one more arg")
+    return [room_file_arg(k) for k in rooms]
+
+
+@register_command("ls", CMD_LIST)
+def cmd_ls(local: ServerRoom, b: str, c: str):
+    # ls [docker,!cert,keyword] [sort]
+    flags = []
+    keyword = ""
+    for word in [w for w in b.split(",") if w != ""]:
+        if word.lstrip("!") in STATUS_FLAGS:
+            flags.append(word)
+        else:
+            keyword = word
+    try:
+        fleet = local.list_fleet(flags=flags, keyword=keyword, sort=c if c != "" else "id")
+    except ValueError as e:
+        err_exit(str(e))
+    table_content = []
+    for server in fleet:
+        content = [server["id"], server["host"]]
+        if server["tunnel_profile"] != "":
+            content.append(f"TUNNEL PROFILE: {server['tunnel_profile']}")
+        content.append("EXPIRED" if server["retired"] else "")
+        # CERT column displays whether default cert or custom cert is used when installed
+        if server["cert"]:
+            if server["cert_is_default"]:
+                content.append("CERT: default")
+            else:
+                content.append(f"CERT: custom ({server['cert_path']})")
+        else:
+            content.append("")
+        content.append("DOCKER" if server["docker"] else "")
+        content.append("DAED" if server["daed"] else "")
+        content.append("YACHT" if server["yacht"] else "")
+        content.append("PY" if server["python"] else "")
+
+        table_content.append(content)
+
+    from tabulate import tabulate
+    print(tabulate(table_content))
+
+
+@register_command("docker-scan", CMD_SCAN_DOCKER)
+def cmd_docker_scan(local: ServerRoom, b: str, c: str):
+    # docker-scan [room file], the containers of all the hosts into the local inventory
+    from machineroom.jobs import door_job
+    from machineroom.scheduler import run_rooms
+    finish_report(run_rooms(room_files_arg(b), lambda job: job.action_docker_scan(), door_job))
+
+
+@register_command("backup", CMD_BACKUP)
+def cmd_backup(local: ServerRoom, b: str, c: str):
+    # backup [room file], the cache db of all the hosts into Config.BACKUP_DIR
+    from machineroom.jobs import ServerDoorJob
+    from machineroom.scheduler import run_rooms
+    finish_report(run_rooms(room_files_arg(b), lambda job: job.action_backup(), ServerDoorJob))
+
+
+@register_command("sync", CMD_SYNC)
+def cmd_sync(local: ServerRoom, b: str, c: str):
+    # sync [room file] [folder], the new and changed files of WS_LOCAL/folder to all the hosts, assets by default
+    from machineroom.jobs import ServerDoorJob
+    from machineroom.scheduler import run_rooms
+    folder = c if c != "" else "assets"
+    finish_report(run_rooms(room_files_arg(b), lambda job: job.action_sync_folder(folder), ServerDoorJob))
+
+
+@register_command("prewarm", CMD_PREWARM)
+def cmd_prewarm(local: ServerRoom, b: str, c: str):
+    # prewarm [count], open the ssh masters of the latest logged in servers in the background
+    from machineroom.jump import prewarm
+    warmed = prewarm(local, int(b) if b.isdigit() else Config.PREWARM_COUNT, use_macos_vpn_on)
+    print(f"{len(warmed)} masters ready: {' '.join(warmed)}")
+
+
+@register_command("close-masters", CMD_CLOSE_MASTERS)
+def cmd_close_masters(local: ServerRoom, b: str, c: str):
+    from machineroom.jump import close_masters
+    print(f"{close_masters()} masters closed")
+
+
+@register_command("containers", CMD_CONTAINERS)
+def cmd_containers(local: ServerRoom, b: str, c: str):
+    # containers [keyword] [state], searched in the inventory of the last docker-scan
+    table_content = []
+    for k in local.find_containers(keyword=b, state=c):
+        table_content.append([k["server_id"], k["host"], k["name"], k["image"], k["state"], k["status"],
+                              " ".join(k["ports"])])
+    from tabulate import tabulate
+    print(tabulate(table_content))
+
+
+@register_command("scanports", CMD_SCAN_PORT)
+def cmd_scanports(local: ServerRoom, b: str, c: str):
+    # scanports [room file], the listening ports of all the hosts as a new snapshot
+    from machineroom.jobs import door_job
+    from machineroom.scheduler import run_rooms
+    finish_report(run_rooms(room_files_arg(b), lambda job: job.action_scan_ports(), door_job))
+
+
+@register_command("listening", CMD_LISTENING)
+def cmd_listening(local: ServerRoom, b: str, c: str):
+    # listening [port], the servers found listening on the port by the last scans
+    if b.isdigit() is False:
+        err_exit("need to have the port number")
+    table_content = []
+    for server in local.port_index(int(b)):
+        seen = datetime.datetime.fromtimestamp(server["seen_at"]).strftime("%Y-%m-%d %H:%M")
+        table_content.append([server["id"], server["host"], f"since {seen}"])
+    from tabulate import tabulate
+    print(tabulate(table_content))
+
+
+@register_command("port-history", CMD_PORT_HISTORY)
+def cmd_port_history(local: ServerRoom, b: str, c: str):
+    # port-history [server id] [count], the latest port changes of the server
+    if b == "":
+        err_exit("need to have one more arg for the server ID")
+    table_content = []
+    for snap in local.port_history(b, int(c) if c.isdigit() else 20, changes_only=True):
+        taken = datetime.datetime.fromtimestamp(snap["taken_at"]).strftime("%Y-%m-%d %H:%M")
+        table_content.append([taken, " ".join([f"+{p}" for p in snap["opened"]] + [f"-{p}" for p in snap["closed"]])])
+    from tabulate import tabulate
+    print(tabulate(table_content))
+
+
+@register_command("import", CMD_IMPORT)
+def cmd_import(local: ServerRoom, b: str, c: str):
+    from machineroom.jobs import door_job
+    from machineroom.scheduler import run_rooms
+    # import [room file] [--full], without --full only the new and changed lines are connected
+    finish_report(run_rooms(room_files_arg(b), lambda job: job.action_import(full=c == "--full"), door_job))
+
+
+@register_command("v", CMD_VERSION)
+def cmd_version(local: ServerRoom, b: str, c: str):
+    print(f"version. {__version__}")
+
+
+@register_command("watch-profile", CMD_GENERATE_PROFILE)
+def cmd_watch_profile(local: ServerRoom, b: str, c: str):
+    from machineroom.jobs import door_job
+    from machineroom.scheduler import run_rooms
+    finish_report(run_rooms(room_files_arg(b), lambda job: job.action_scan_ports(), door_job))
+
+
+@register_command("set-home", CMD_SET_BASH_START)
+def cmd_set_home(local: ServerRoom, b: str, c: str):
+    if b == "":
+        err_exit("need to have one more arg for the server ID")
+    if c == "":
+        err_exit("need to have one more arg for the the remote start path, for example /home")
+    local.set_server_id(b)
+    if local.has_this_server() is False:
+        err_exit(f"there is no such server for ---> {b}")
+    local.update_res_kv("home_path", c)
+
+
+@register_command("retire", CMD_RETIRE)
+def cmd_retire(local: ServerRoom, b: str, c: str):
+    from machineroom.jobs import ServerDoorJob
+    from machineroom.scheduler import run_rooms
+    finish_report(run_rooms(room_files_arg(b), lambda job: job.action_retire(), ServerDoorJob, online=False))
+
+
+@register_command("off-cert", CMD_OFF_CERT)
+def cmd_off_cert(local: ServerRoom, b: str, c: str):
+    from machineroom.jobs import ServerDoorJob
+    from machineroom.scheduler import run_rooms
+    finish_report(run_rooms(room_files_arg(b), lambda job: job.action_off_cert(), ServerDoorJob, online=False))
+
+
+@register_command("add-cert", CMD_ADD_CERT)
+def cmd_add_cert(local: ServerRoom, b: str, c: str):
+    print("You are about to adding custom certificate to all servers on behalf this machine room.")
+    from machineroom.jobs import ServerDoorJob
+    from machineroom.scheduler import run_rooms
+    room_files = room_files_arg(b)
+    key_path = input(
+        "Enter the path of the pub file. For example /Users/{user_name_here}/.ssh/{user_custom_public_key}.pub")
+    cert_name = input(
+        "Enter the name of the pub file. open the .pub file and usually its located at the very last word of the key file.")
+
+    finish_report(run_rooms(room_files, lambda job: job.action_add_custom_cert(cert_name, key_path), ServerDoorJob))
+
+
+@register_command("remove-custom-cert")
+def cmd_remove_custom_cert(local: ServerRoom, b: str, c: str):
+    from machineroom.jobs import ServerDoorJob
+    from machineroom.scheduler import run_rooms
+    room_files = room_files_arg(b)
+    cert_name = input(
+        "Enter the name of the pub file. open the .pub file and usually its located at the very last word of the key file.")
+    finish_report(run_rooms(room_files, lambda job: job.action_remove_custom_cert(cert_name), ServerDoorJob))
+
+
+def jump_to_server(local: ServerRoom, a: str):
+    """
+    open the interactive ssh session to the server id, reusing its ControlMaster connection
+    """
+    local.set_server_id(a)
+    if local.has_this_server() is False:
+        err_exit(f"there is no such server for ---> {a}")
+    from machineroom.jump import jump
+    jump(local, a, use_macos_vpn_on)
+
 
 # if __name__ == '__main__':
 #    internal_work()
@@ -0,0 +1,195 @@
+"""
+the asyncio backend against an asyncssh server running in this process on localhost.
+the server runs each command with the local shell, without stdin, and serves sftp from the local disk.
+"""
+import asyncio
+import os
+import subprocess
+import threading
+
+import pytest
+
+asyncssh = pytest.importorskip("asyncssh")
+
+from machineroom.const import Config
+
+PASSWORD = "pw"
+
+
+class FakeServer(asyncssh.SSHServer):
+    def begin_auth(self, username: str) -> bool:
+        return True
+
+    def password_auth_supported(self) -> bool:
+        return True
+
+    def validate_password(self, username: str, password: str) -> bool:
+        return password == PASSWORD
+
+
+def run_locally(process):
+    r = subprocess.run(process.command, shell=True, stdin=subprocess.DEVNULL, capture_output=True, text=True)
+    process.stdout.write(r.stdout)
+    process.stderr.write(r.stderr)
+    process.exit(r.returncode)
+
+
+@pytest.fixture
+def fake_ssh():
+    """
+    the port of the fake server, its event loop runs in a thread so asyncio.run can be called in the tests
+    """
+    loop = asyncio.new_event_loop()
+
+    async def start():
+        key = asyncssh.generate_private_key("ssh-ed25519")
+        return await asyncssh.create_server(FakeServer, "127.0.0.1", 0, server_host_keys=[key],
+                                            process_factory=run_locally, sftp_factory=True)
+
+    server = loop.run_until_complete(start())
+    thread = threading.Thread(target=loop.run_forever, daemon=True)
+    thread.start()
+    yield server.sockets[0].getsockname()[1]
+
+    async def stop():
+        # the sessions and their sftp handlers end before the loop does
+        server.close()
+        await server.wait_closed()
+
+    asyncio.run_coroutine_threadsafe(stop(), loop).result(5)
+    loop.call_soon_threadsafe(loop.stop)
+    thread.join(5)
+    loop.close()
+
+
+@pytest.fixture
+def room(tmp_path, monkeypatch):
+    """
+    write a room file into a fresh DATAPATH_BASE, returns the writer taking the lines of the hosts
+    """
+    monkeypatch.setattr(Config, "DATAPATH_BASE", str(tmp_path))
+    monkeypatch.setattr(Config, "STAGE1", [])
+    monkeypatch.setattr(Config, "ASYNC_CONNECT_TIMEOUT", 5)
+
+    def write(hosts: list) -> str:
+        with open(tmp_path / "room.txt", "w") as f:
+            for (server_id, password, port) in hosts:
+                f.write(f"{server_id}---127.0.0.1---root---{password}---{port}\n")
+        return "room.txt"
+
+    return write
+
+
+def test_run_conn_async_runs_every_host(fake_ssh, room, tmp_path):
+    from machineroom.aio import AsyncDeploymentBotFoundation, exec_shell_program_async
+
+    bot = AsyncDeploymentBotFoundation(room([(f"a{i}", PASSWORD, fake_ssh) for i in range(4)]))
+
+    async def callback(c, srv):
+        r = await exec_shell_program_async(c, str(tmp_path), f"echo {srv.current_id}-$((1+1))")
+        return r.stdout.strip()
+
+    results = asyncio.run(bot.run_conn_async(callback))
+    assert [r.ok for r in results] == [True] * 4
+    assert [r.value for r in results] == ["a0-2", "a1-2", "a2-2", "a3-2"]
+    assert [r.server_id for r in results] == ["a0", "a1", "a2", "a3"]
+    assert all(r.commands == 1 and r.exit_status == 0 for r in results)
+    # the uploaded scripts remove themselves
+    assert [f for f in os.listdir(tmp_path) if f.startswith("mr_")] == []
+
+
+def test_run_conn_async_keeps_going_after_a_failed_host(fake_ssh, room):
+    from machineroom.aio import AsyncDeploymentBotFoundation
+
+    bot = AsyncDeploymentBotFoundation(room([("b0", PASSWORD, fake_ssh), ("b1", "wrong", fake_ssh),
+                                             ("b2", PASSWORD, fake_ssh)]))
+
+    async def callback(c, srv):
+        r = await c.run("exit 3")
+        return r.exited
+
+    results = asyncio.run(bot.run_conn_async(callback))
+    assert [r.ok for r in results] == [True, False, True]
+    assert results[1].server_id == "b1"
+    assert isinstance(results[1].error, asyncssh.PermissionDenied)
+    assert results[0].value == 3 and results[0].exit_status == 3
+
+
+def test_run_conn_async_uploads_over_sftp(fake_ssh, room, tmp_path):
+    from machineroom.aio import AsyncDeploymentBotFoundation
+
+    bot = AsyncDeploymentBotFoundation(room([("c0", PASSWORD, fake_ssh)]))
+    remote = str(tmp_path / "uploaded.txt")
+
+    async def callback(c, srv):
+        await c.put("hello sftp\n".encode("utf-8"), remote)
+        return (await c.run(f"cat {remote}")).stdout
+
+    results = asyncio.run(bot.run_conn_async(callback, [0]))
+    assert results[0].ok, results[0].error
+    assert results[0].value == "hello sftp\n"
+
+
+def test_run_conn_async_connects_on_the_port_of_the_room_file(fake_ssh, room):
+    from machineroom.aio import AsyncDeploymentBotFoundation
+
+    bot = AsyncDeploymentBotFoundation(room([("d0", PASSWORD, fake_ssh)]))
+
+    async def callback(c, srv):
+        return c.port
+
+    results = asyncio.run(bot.run_conn_async(callback))
+    assert results[0].ok, results[0].error
+    assert results[0].value == fake_ssh
+
+
+def test_run_conn_async_writes_each_host_batch_at_its_own_end(fake_ssh, room, tmp_path):
+    import json
+    import sqlite3
+    from machineroom.aio import AsyncDeploymentBotFoundation
+
+    bot = AsyncDeploymentBotFoundation(room([("e0", PASSWORD, fake_ssh), ("e1", PASSWORD, fake_ssh)]))
+    second_wrote = asyncio.Event()
+    first_done = asyncio.Event()
+
+    def stored(server_id: str) -> str:
+        with sqlite3.connect(tmp_path / "cache.db") as db:
+            (res,) = db.execute("SELECT res FROM server_room WHERE id = ?", (server_id,)).fetchone()
+        return json.loads(res).get("probe", "") if res else ""
+
+    async def callback(c, srv):
+        if srv.current_id == "e0":
+            # ends its batch while e1 is in the middle of its own
+            await second_wrote.wait()
+            srv.local().update_res_kv("probe", srv.current_id)
+            first_done.set()
+            return ""
+        srv.local().update_res_kv("probe", srv.current_id)
+        second_wrote.set()
+        await first_done.wait()
+        # e0 has flushed its batch by now, the update of e1 is still waiting for the end of its own
+        await asyncio.sleep(0.1)
+        return stored("e1")
+
+    results = asyncio.run(bot.run_conn_async(callback))
+    assert [r.ok for r in results] == [True, True]
+    assert results[1].value == ""
+    assert stored("e0") == "e0" and stored("e1") == "e1"
+
+
+def test_run_conn_async_fails_the_stages_it_cannot_run(fake_ssh, room, monkeypatch):
+    from machineroom.aio import AsyncDeploymentBotFoundation
+    from machineroom.errs import MachineRoomErr
+
+    bot = AsyncDeploymentBotFoundation(room([("f0", PASSWORD, fake_ssh)]))
+    monkeypatch.setattr(Config, "STAGE1", ["env", "python", "yacht9055"])
+
+    results = asyncio.run(bot.run_conn_async())
+    assert results[0].ok is False
+    assert isinstance(results[0].error, MachineRoomErr)
+    assert "yacht9055" in str(results[0].error)
+    # python3 is on this machine, the stage found it in the facts and installed nothing
+    local = bot.srv.local().view()
+    local.set_server_id("f0")
+    assert local.get_facts(Config.FACTS_TTL_SECONDS)["paths"]["python3"] != ""
+    assert local.is_python_installed() is False